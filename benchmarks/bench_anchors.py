@@ -0,0 +1,81 @@
+"""
+Benchmark of the equation anchor styles (metadata `equation-anchor-style`): size of the JSON AST produced by the filter, and time and output size of the pandoc writers, for nested divs and flat anchors.
+
+Requires `pandoc` in the PATH.
+
+Usage: python benchmarks/bench_anchors.py
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from docgen import make_doc
+from panflute import Div, dump
+from pandoc_tex_numbering.pandoc_tex_numbering import run_numbering
+
+WRITERS = ["html", "latex", "docx"]
+MAX_ROWS = [5, 20]
+SECTIONS = 20
+
+
+def div_depth(elem):
+    # Maximum number of nested divs
+    depth = 0
+    while isinstance(elem, Div) and len(elem.content) == 1:
+        depth += 1
+        elem = elem.content[0]
+    return depth
+
+
+def filtered_json(output_format, anchor_style, max_rows):
+    doc = make_doc(
+        sections=SECTIONS,
+        output_format=output_format,
+        metadata={"equation-anchor-style": anchor_style},
+        max_rows=max_rows,
+    )
+    run_numbering(doc)
+    depth = max(div_depth(block) for block in doc.content)
+    buffer = StringIO()
+    dump(doc, buffer)
+    return buffer.getvalue().encode("utf-8"), depth
+
+
+def write(ast_json, output_format):
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, f"output.{output_format}")
+        start = time.perf_counter()
+        subprocess.run(
+            ["pandoc", "-f", "json", "-t", output_format, "-o", output],
+            input=ast_json,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        duration = time.perf_counter() - start
+        return duration, os.path.getsize(output)
+
+
+def main():
+    logging.getLogger("pandoc-tex-numbering").setLevel(logging.ERROR)
+    print(
+        f"{'writer':>8}{'rows':>6}{'style':>8}{'depth':>7}{'AST (KB)':>10}{'write (ms)':>12}{'output (KB)':>13}"
+    )
+    for output_format in WRITERS:
+        for max_rows in MAX_ROWS:
+            for anchor_style in ["nested", "flat"]:
+                ast_json, depth = filtered_json(output_format, anchor_style, max_rows)
+                duration, size = min(write(ast_json, output_format) for _ in range(3))
+                print(
+                    f"{output_format:>8}{max_rows:>6}{anchor_style:>8}{depth:>7}{len(ast_json)/1024:>10.1f}{duration*1e3:>12.1f}{size/1024:>13.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark of the docx list of figures/tables generation (`docx_list_body`): generation time and output size for different numbers of entries and chunk sizes.
+
+Usage: python benchmarks/bench_docx_list.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from pandoc_tex_numbering.docx_list import docx_list_body
+
+ENTRY_COUNTS = [100, 1000, 3000]
+# A chunk size larger than the number of entries puts the whole list into one paragraph
+CHUNK_SIZES = [1, 10, 100, 10**9]
+
+
+def make_items(count):
+    return [
+        (
+            f"Figure {i // 50 + 1}.{i % 50 + 1}: Caption of the figure number {i}",
+            f"fig:{i}",
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    print(f"{'entries':>8}{'chunk':>12}{'blocks':>8}{'time (ms)':>11}{'size (KB)':>11}")
+    for count in ENTRY_COUNTS:
+        items = make_items(count)
+        for chunk_size in CHUNK_SIZES:
+            if count <= chunk_size < CHUNK_SIZES[-1]:
+                continue
+            blocks = docx_list_body(items, leader_type="dot", chunk_size=chunk_size)
+            timer = timeit.Timer(
+                lambda: docx_list_body(items, leader_type="dot", chunk_size=chunk_size)
+            )
+            duration = min(timer.repeat(repeat=3, number=1))
+            size = sum(len(block.text.encode("utf-8")) for block in blocks)
+            chunk = "all" if chunk_size >= count else chunk_size
+            print(
+                f"{count:>8}{chunk:>12}{len(blocks):>8}{duration*1e3:>11.1f}{size/1024:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark of the output-format-aware pipeline: filter time for different output formats, with `format-aware` enabled and disabled.
+
+Usage: python benchmarks/bench_formats.py
+"""
+
+import gc
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from docgen import make_doc
+from pandoc_tex_numbering.pandoc_tex_numbering import output_plan, run_numbering
+
+FORMATS = ["docx", "html", "latex", "markdown", "markdown_strict", "plain"]
+REPEAT = 5
+SECTIONS = 30
+
+
+def run(output_format, format_aware):
+    durations = []
+    for _ in range(REPEAT):
+        doc = make_doc(
+            sections=SECTIONS,
+            output_format=output_format,
+            metadata={"format-aware": format_aware, "custom-lof": True},
+        )
+        gc.collect()
+        start = time.perf_counter()
+        run_numbering(doc)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    logging.getLogger("pandoc-tex-numbering").setLevel(logging.ERROR)
+    print(f"{'format':>16}{'skipped stages':>36}{'full (ms)':>11}{'aware (ms)':>12}")
+    for output_format in FORMATS:
+        plan = output_plan(output_format)
+        skipped = ",".join(stage for stage, enabled in plan.items() if not enabled)
+        full = run(output_format, False)
+        aware = run(output_format, True)
+        print(
+            f"{output_format:>16}{skipped or '-':>36}{full*1e3:>11.1f}{aware*1e3:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark of the JSON codecs of the filter I/O (see `codec.py`): decoding the input AST into panflute elements, encoding the output AST and dumping the data export, for generated documents of different sizes. The codecs are timed like the command line filter calls them, with the garbage collector paused. The plain standard library path with the garbage collector running (what `panflute.load` and `panflute.dump` do) is given for comparison.
+
+Usage: python benchmarks/bench_json.py
+"""
+
+import gc
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from docgen import make_doc
+from panflute.elements import from_json
+from pandoc_tex_numbering.codec import (
+    StdlibCodec,
+    available_codecs,
+    element_to_json,
+    paused_gc,
+)
+from pandoc_tex_numbering.pandoc_tex_numbering import run_numbering, serialize
+
+SECTIONS = [20, 100, 300]
+REPEAT = 3
+
+
+class PlainCodec:
+    # The standard library as called by panflute, with the garbage collector running
+    name = "panflute"
+
+    def load_doc(self, data):
+        return json.loads(data, object_hook=from_json)
+
+    def dumps(self, obj, indent=False):
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(
+            obj,
+            default=element_to_json,
+            check_circular=False,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode("utf-8")
+
+
+def best(func, pause_gc=True):
+    durations = []
+    for _ in range(REPEAT):
+        gc.collect()
+        start = time.perf_counter()
+        if pause_gc:
+            with paused_gc():
+                func()
+        else:
+            func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    logging.getLogger("pandoc-tex-numbering").setLevel(logging.ERROR)
+    codecs = [PlainCodec()] + available_codecs()
+    print(
+        f"{'sections':>9}{'size (MB)':>11}{'codec':>10}{'decode (ms)':>13}{'encode (ms)':>13}{'export (ms)':>13}"
+    )
+    for sections in SECTIONS:
+        doc = make_doc(sections=sections, output_format="json")
+        data = serialize(doc, StdlibCodec())
+        results = {}
+        run_numbering(doc, results)
+        ref_index = results["ref_index"]
+        for codec in codecs:
+            # The decoded documents stay alive, like in the filter
+            docs = []
+            pause_gc = not isinstance(codec, PlainCodec)
+            decode = best(lambda: docs.append(codec.load_doc(data)), pause_gc)
+            encode = best(lambda: codec.dumps(docs[-1]), pause_gc)
+            export = best(lambda: codec.dumps(ref_index, indent=True), pause_gc)
+            print(
+                f"{sections:>9}{len(data)/2**20:>11.1f}{codec.name:>10}{decode*1e3:>13.1f}{encode*1e3:>13.1f}{export*1e3:>13.1f}"
+            )
+            del docs
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Benchmark of the numeral conversions in `lang_num.py`: the plain conversion functions against the cached ones in `language_functions`.
+
+Usage: python benchmarks/bench_lang_num.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from pandoc_tex_numbering.lang_num import language_functions
+
+# Small numbers are the typical section/figure/equation numbers, large numbers are beyond the lookup tables
+CASES = {"small": range(1, 50), "large": range(100000, 100050)}
+
+
+def bench(func, nums, repeat=5, number=200):
+    timer = timeit.Timer(lambda: [func(num) for num in nums])
+    return min(timer.repeat(repeat=repeat, number=number)) / number / len(nums)
+
+
+def main():
+    print(f"{'style':<10}{'case':<8}{'plain (ns)':>12}{'cached (ns)':>13}")
+    for style, cached in language_functions.items():
+        for case, nums in CASES.items():
+            plain_time = bench(cached.func, nums)
+            cached_time = bench(cached, nums)
+            print(
+                f"{style:<10}{case:<8}{plain_time*1e9:>12.0f}{cached_time*1e9:>13.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark of numbering and formatting items (`NumberingState` and `Numbering`): time per equation for different numbers of equations per section. Every equation is formatted with all presets, as for the source, the data export and a few references.
+
+Usage: python benchmarks/bench_numbering.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from pandoc_tex_numbering.numbering import Formater, NumberingState
+
+MAX_LEVELS = 10
+EQUATIONS = 5000
+EQUATIONS_PER_SECTION = [1, 10, 100, 1000]
+REFERENCES_PER_EQUATION = 3
+
+
+def make_state():
+    presets = {"src": None, "ref": "{num}", "cref": "{prefix}{num}", "Cref": None}
+    formaters = {
+        "eq": Formater({**presets, "src": "\\qquad({num})"}, "eq", prefix="Equation"),
+        "sec": [Formater(presets, "sec", prefix="Section")] * MAX_LEVELS,
+        "apx": [Formater(presets, "apx", prefix="Appendix")] * MAX_LEVELS,
+    }
+    return NumberingState(formaters, reset_level=2, max_levels=MAX_LEVELS, offsets={})
+
+
+def run(per_section):
+    state = make_state()
+    state.next_sec(1)
+    start = time.perf_counter()
+    for i in range(EQUATIONS):
+        if i % per_section == 0:
+            state.next_sec(2)
+        state.next("eq")
+        num_obj = state.current("eq")
+        for preset in ["src", "ref", "cref", "Cref"]:
+            num_obj.format(fmt_preset=preset)
+        for _ in range(REFERENCES_PER_EQUATION):
+            num_obj.format(fmt_preset="ref")
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'per section':>12}{'total (ms)':>12}{'per item (us)':>15}")
+    for per_section in EQUATIONS_PER_SECTION:
+        duration = min(run(per_section) for _ in range(3))
+        print(f"{per_section:>12}{duration*1e3:>12.1f}{duration/EQUATIONS*1e6:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
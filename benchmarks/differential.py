@@ -0,0 +1,459 @@
+"""
+Differential test of the execution paths of the filter: randomized documents (see `docgen.py`) with randomized metadata (numbering styles, offsets, reset levels, appendices, custom formats, custom environments and their resets, output formats, multiple references, ...) are numbered by a reference run and by every alternative mode, and the results must be identical.
+
+The reference run numbers a document loaded by panflute in process, with the multiline equation cache disabled and without skipping the passes the census found empty, and serializes it with the standard library. The alternative modes are listed in `MODES`: warm caches, every available JSON codec (also for the data export), the Python API (also from several threads at once), the index-only mode, the JSON Lines export, and the command line filter with and without the on-disk result cache, and with a numbering artifact saved by a run for another output format. For the first divergence of every mode, the first divergent AST node and the diff of the label data are reported.
+
+Everything runs offline: the command line filter is run on JSON input, pandoc is not needed.
+
+Usage: python benchmarks/differential.py [--cases N] [--seed S] [--modes mode1,mode2] [--no-cli]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import warnings
+from io import StringIO
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from docgen import THEOREM_NAMES, make_doc
+from panflute import Div, Header, Link, Para, Span, Str, load, stringify
+from pandoc_tex_numbering import pandoc_tex_numbering as ptn
+from pandoc_tex_numbering.cache import LRUCache
+from pandoc_tex_numbering.codec import StdlibCodec, available_codecs
+
+FORMATS = ["html", "latex", "docx", "markdown", "plain", "json"]
+NUMSTYLES = ["arabic", "roman", "Roman", "latin", "Latin", "greek", "zh"]
+THREADS = 4
+# Custom environments declared by some cases (see `add_environments`), the second one can be reset by the first one
+ENVIRONMENT_NAMES = ["listing", "exercise"]
+ENVIRONMENT_RESETS = [
+    "section",
+    "none",
+    "figure",
+    "equation",
+    f"theorem-{THEOREM_NAMES[0]}",
+]
+
+
+class Case:
+    def __init__(self, seed):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.output_format = rng.choice(FORMATS)
+        doc = make_doc(
+            sections=rng.randint(1, 6),
+            items_per_section=rng.randint(1, 12),
+            seed=seed,
+            output_format=self.output_format,
+            missing_ratio=rng.choice([0.0, 0.0, 0.1]),
+            max_rows=rng.randint(2, 8),
+            references=rng.choice(["text", "text", "text", "captions", "none"]),
+        )
+        with_environments = rng.random() < 0.5
+        if with_environments:
+            add_environments(rng, doc)
+        self.metadata = random_metadata(rng, doc, with_environments)
+        for key, value in self.metadata.items():
+            doc.metadata[key] = value
+        self.ast_json = ptn.serialize(doc, StdlibCodec()).decode("utf-8")
+
+    def __repr__(self):
+        return f"Case(seed={self.seed}, format={self.output_format})"
+
+
+def add_environments(rng, doc):
+    # Divs of the custom environments between the top-level blocks, labelled by their identifiers, by a label span (like the divs pandoc creates for unknown LaTeX environments) or not at all, and references to them
+    labels = []
+    blocks = []
+    for idx, block in enumerate(doc.content):
+        blocks.append(block)
+        if rng.random() < 0.25:
+            name = rng.choice(ENVIRONMENT_NAMES)
+            label = f"{name[:3]}:{idx}"
+            kind = rng.choice(["identifier", "span", "none"])
+            content = [Str(name.capitalize())]
+            if kind == "span":
+                content.insert(0, Span(attributes={"label": label}))
+            blocks.append(
+                Div(
+                    Para(*content),
+                    identifier=label if kind == "identifier" else "",
+                    classes=[name],
+                )
+            )
+            if kind != "none":
+                labels.append(label)
+    if labels:
+        references = [
+            Link(
+                Str(f"[{label}]"),
+                url=f"#{label}",
+                attributes={"reference-type": "ref", "reference": label},
+            )
+            for label in rng.sample(labels, min(len(labels), 3))
+        ]
+        blocks.append(Para(*references))
+    doc.content = blocks
+
+
+def random_metadata(rng, doc, with_environments=False):
+    metadata = {}
+
+    def maybe(key, values, probability=0.3):
+        if rng.random() < probability:
+            metadata[key] = rng.choice(values)
+
+    maybe("number-reset-level", ["1", "2", "3"], 0.5)
+    for level in [1, 2]:
+        maybe(f"section-numstyle-{level}", NUMSTYLES)
+        maybe(f"section-offset-{level}", ["0", "1", "4"])
+        maybe(f"appendix-numstyle-{level}", NUMSTYLES)
+    for item in ["figure", "table", "equation", "subfigure"]:
+        maybe(f"{item}-numstyle", NUMSTYLES)
+        maybe(f"{item}-offset", ["0", "2", "9"])
+    for name in THEOREM_NAMES:
+        maybe(f"theorem-{name}-offset", ["1", "3"])
+        maybe(f"theorem-{name}-prefix", [name.upper(), "Thm"])
+    maybe("prefix-space", [True, False])
+    maybe("figure-prefix", ["Fig.", "图"])
+    maybe("figure-cref-format", ["{Prefix} {fig_id} (in Section {h1})"])
+    if with_environments:
+        metadata["environment-names"] = ",".join(ENVIRONMENT_NAMES)
+        for idx, name in enumerate(ENVIRONMENT_NAMES):
+            # Only the later environments can be reset by the earlier ones, so that the resets have no cycle
+            maybe(
+                f"environment-{name}-reset-by",
+                ENVIRONMENT_RESETS + ENVIRONMENT_NAMES[:idx],
+                0.7,
+            )
+            maybe(f"environment-{name}-numstyle", NUMSTYLES)
+            maybe(f"environment-{name}-offset", ["0", "2"])
+    maybe("equation-src-format", ["\\qquad[{num}]", "\\tag{{{num}}}"])
+    maybe("section-src-format-1", ["Chapter {h1_Roman}", "第{h1_zh}章"])
+    # The last level 1 sections become appendices
+    titles = [
+        stringify(elem)
+        for elem in doc.content
+        if isinstance(elem, Header) and elem.level == 1
+    ]
+    if titles and rng.random() < 0.5:
+        metadata["appendix-names"] = "/,".join(titles[-rng.randint(1, len(titles)) :])
+    maybe("multiple-ref-suppress", [True, False], 0.5)
+    maybe("multiple-ref-style", ["simple", "full"], 0.5)
+    maybe("multiple-ref-separator", [", ", "; "])
+    maybe("multiple-ref-last-separator", [" and ", " & "])
+    maybe("multiple-ref-to", ["-", " to "])
+    maybe("equation-anchor-style", ["nested", "flat"], 0.5)
+    maybe("equation-parse-max-cells", ["2", "5"], 0.2)
+    maybe("multiline-environments", ["align", "cases,align,gather"], 0.2)
+    maybe("custom-lof", [True, False])
+    maybe("custom-lot", [True, False])
+    maybe("list-chunk-size", ["1", "3"])
+    maybe("auto-labelling", [True, False])
+    maybe("format-aware", [True, False])
+    return metadata
+
+
+def normalize(ref_index):
+    # Tuples and lists are compared as JSON, like the exported data
+    return json.loads(json.dumps(ref_index))
+
+
+def run_in_process(case, overrides=None):
+    doc = load(StringIO(case.ast_json))
+    doc.format = case.output_format
+    for key, value in (overrides or {}).items():
+        doc.metadata[key] = value
+    results = {}
+    doc = ptn.run_numbering(doc, results)
+    return ptn.serialize(doc, StdlibCodec()), results["ref_index"]
+
+
+def run_reference(case):
+    # Every multiline equation is parsed again, a cache of size 0 never hits, and every pass runs even if the census found nothing for it
+    cache = ptn.MATH_STRUCTURE_CACHE
+    ptn.MATH_STRUCTURE_CACHE = LRUCache(maxsize=0)
+    try:
+        output, ref_index = run_in_process(case, {"skip-empty-passes": False})
+    finally:
+        ptn.MATH_STRUCTURE_CACHE = cache
+    return without_metadata(output, ["skip-empty-passes"]), ref_index
+
+
+# Every mode returns a list of (output AST, label data), the output is None when it is not comparable to the reference
+def mode_warm_cache(case):
+    run_in_process(case)
+    return [run_in_process(case)]
+
+
+def mode_codecs(case):
+    # The Python API with every available codec, for the AST and for the data export
+    results = []
+    default_codec = ptn.JSON_CODEC
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "data.json")
+        for codec in available_codecs():
+            ptn.JSON_CODEC = codec
+            try:
+                output, _ = ptn.number_document(
+                    case.ast_json,
+                    {"data-export-path": path},
+                    output_format=case.output_format,
+                )
+            finally:
+                ptn.JSON_CODEC = default_codec
+            with open(path, encoding="utf-8") as f:
+                ref_index = json.load(f)
+            results.append((without_metadata(output, ["data-export-path"]), ref_index))
+    return results
+
+
+def mode_api(case):
+    return [ptn.number_document(case.ast_json, output_format=case.output_format)]
+
+
+def mode_api_threads(case):
+    results = [None] * THREADS
+    barrier = threading.Barrier(THREADS)
+
+    def work(idx):
+        barrier.wait()
+        results[idx] = ptn.number_document(
+            case.ast_json.encode("utf-8"), output_format=case.output_format
+        )
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def mode_index_only(case):
+    output, ref_index = ptn.number_document(
+        case.ast_json, {"index-only": True}, output_format=case.output_format
+    )
+    assert output == case.ast_json.encode("utf-8"), "index-only modified the document"
+    return [(None, ref_index)]
+
+
+def mode_jsonl_export(case):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "data.jsonl")
+        output, _ = ptn.number_document(
+            case.ast_json,
+            {"data-export-path": path, "data-export-format": "jsonl"},
+            output_format=case.output_format,
+        )
+        ref_index = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                ref_index[item.pop("label")] = item
+    return [
+        (
+            without_metadata(output, ["data-export-path", "data-export-format"]),
+            ref_index,
+        )
+    ]
+
+
+def without_metadata(output, keys):
+    # Metadata added to the input for the export are kept in the output
+    output = json.loads(output)
+    for key in keys:
+        del output["meta"][key]
+    return json.dumps(output).encode("utf-8")
+
+
+def run_cli(case, tmp_dir, env=None, output_format=None):
+    # The filter reads the JSON AST from stdin, the output format is its first argument, like when called by pandoc
+    path = os.path.join(tmp_dir, "data.json")
+    ast_json = json.loads(case.ast_json)
+    ast_json["meta"]["data-export-path"] = {"t": "MetaString", "c": path}
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.path.insert(0, sys.argv.pop(1)); from pandoc_tex_numbering import main; main()",
+            SRC_DIR,
+            output_format or case.output_format,
+        ],
+        input=json.dumps(ast_json).encode("utf-8"),
+        capture_output=True,
+        cwd=tmp_dir,
+        env={**os.environ, **(env or {})},
+        check=True,
+    )
+    with open(path, encoding="utf-8") as f:
+        ref_index = json.load(f)
+    os.unlink(path)
+    return without_metadata(process.stdout, ["data-export-path"]), ref_index
+
+
+def mode_cli(case):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        return [run_cli(case, tmp_dir)]
+
+
+def mode_cli_result_cache(case):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = {"PANDOC_TEX_NUMBERING_CACHE_DIR": os.path.join(tmp_dir, "cache")}
+        # A miss then a hit
+        return [run_cli(case, tmp_dir, env), run_cli(case, tmp_dir, env)]
+
+
+def mode_cli_artifact(case):
+    # The numbering artifact is saved by a run for another output format, then the run for the format of the case only applies the format-specific steps
+    other_format = "plain" if case.output_format != "plain" else "docx"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = {"PANDOC_TEX_NUMBERING_ARTIFACT": os.path.join(tmp_dir, "artifact")}
+        run_cli(case, tmp_dir, env, output_format=other_format)
+        return [run_cli(case, tmp_dir, env)]
+
+
+MODES = {
+    "warm-cache": mode_warm_cache,
+    "codecs": mode_codecs,
+    "api": mode_api,
+    "api-threads": mode_api_threads,
+    "index-only": mode_index_only,
+    "jsonl-export": mode_jsonl_export,
+    "cli": mode_cli,
+    "cli-result-cache": mode_cli_result_cache,
+    "cli-artifact": mode_cli_artifact,
+}
+CLI_MODES = ["cli", "cli-result-cache", "cli-artifact"]
+
+
+def first_difference(expected, actual, path="$"):
+    # Returns (path, expected node, actual node) of the first difference in document order, or None
+    if type(expected) != type(actual):
+        return path, expected, actual
+    if isinstance(expected, dict):
+        for key in list(expected) + [key for key in actual if not key in expected]:
+            if not key in expected or not key in actual:
+                return f"{path}.{key}", expected.get(key), actual.get(key)
+            difference = first_difference(expected[key], actual[key], f"{path}.{key}")
+            if difference:
+                return difference
+        return None
+    if isinstance(expected, list):
+        for idx, (a, b) in enumerate(zip(expected, actual)):
+            difference = first_difference(a, b, f"{path}[{idx}]")
+            if difference:
+                return difference
+        if len(expected) != len(actual):
+            idx = min(len(expected), len(actual))
+            return (
+                f"{path}[{idx}]",
+                expected[idx] if idx < len(expected) else None,
+                actual[idx] if idx < len(actual) else None,
+            )
+        return None
+    return None if expected == actual else (path, expected, actual)
+
+
+def ref_index_diff(expected, actual):
+    lines = []
+    for label in sorted(set(expected) | set(actual)):
+        if not label in actual:
+            lines.append(f"  - {label}: {expected[label]}")
+        elif not label in expected:
+            lines.append(f"  + {label}: {actual[label]}")
+        elif expected[label] != actual[label]:
+            for key in sorted(set(expected[label]) | set(actual[label])):
+                if expected[label].get(key) != actual[label].get(key):
+                    lines.append(
+                        f"  ~ {label}.{key}: {expected[label].get(key)!r} -> {actual[label].get(key)!r}"
+                    )
+    return lines
+
+
+def shorten(node, width=300):
+    text = json.dumps(node, ensure_ascii=False)
+    return text if len(text) <= width else text[:width] + "..."
+
+
+def compare(reference, result):
+    # Returns the report lines of the differences, empty if the results are identical
+    ref_output, ref_index = reference
+    output, index = result
+    lines = []
+    if not output is None:
+        difference = first_difference(json.loads(ref_output), json.loads(output))
+        if difference:
+            path, expected, actual = difference
+            lines.append(f"  first divergent AST node: {path}")
+            lines.append(f"    reference: {shorten(expected)}")
+            lines.append(f"    mode:      {shorten(actual)}")
+    index_lines = ref_index_diff(normalize(ref_index), normalize(index))
+    if index_lines:
+        lines.append("  label data diff (reference -> mode):")
+        lines.extend(index_lines)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--cases", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument(
+        "--no-cli", action="store_true", help="skip the command line modes (slower)"
+    )
+    args = parser.parse_args()
+    modes = [
+        mode
+        for mode in args.modes.split(",")
+        if not (args.no_cli and mode in CLI_MODES)
+    ]
+    for mode in modes:
+        assert mode in MODES, f"Unknown mode: {mode}"
+
+    logging.getLogger("pandoc-tex-numbering").setLevel(logging.ERROR)
+    warnings.simplefilter("ignore")
+    diverged = set()
+    for seed in range(args.seed, args.seed + args.cases):
+        case = Case(seed)
+        reference = run_reference(case)
+        status = []
+        for mode in modes:
+            for idx, result in enumerate(MODES[mode](case)):
+                lines = compare(reference, result)
+                if not lines:
+                    continue
+                status.append(mode)
+                # Only the first divergence of every mode is reported in detail
+                if not mode in diverged:
+                    diverged.add(mode)
+                    print(f"{case}: mode {mode} (result {idx}) diverges")
+                    print(f"  metadata: {case.metadata}")
+                    print("\n".join(lines))
+                break
+        print(
+            f"seed {seed:>5} {case.output_format:>9} {len(reference[1]):>5} labels: "
+            + (f"DIVERGED ({','.join(status)})" if status else "ok")
+        )
+    print(
+        f"{args.cases} cases, {len(modes)} modes: "
+        + (
+            f"divergent modes: {','.join(sorted(diverged))}"
+            if diverged
+            else "no divergence"
+        )
+    )
+    return 1 if diverged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
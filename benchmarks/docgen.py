@@ -0,0 +1,209 @@
+"""
+Generator of synthetic documents for the benchmarks: a panflute `Doc` with the same structure as the AST pandoc produces from a LaTeX source (sections, labelled equations and multi-line equations, figures with subfigures, tables, theorems and cross references).
+
+The generation is deterministic for a given seed, so that different runs (or different versions of the filter) work on identical documents.
+"""
+
+import random
+
+from panflute import (
+    Caption,
+    Div,
+    Doc,
+    Figure,
+    Header,
+    Image,
+    Link,
+    Math,
+    MetaMap,
+    Para,
+    Plain,
+    Space,
+    Str,
+    Table,
+    TableBody,
+    TableCell,
+    TableRow,
+)
+
+THEOREM_NAMES = ["theorem", "lemma", "definition"]
+REFERENCE_TYPES = ["ref", "ref+label", "ref+Label"]
+
+
+def _words(rng, count):
+    words = []
+    for i in range(count):
+        if i:
+            words.append(Space())
+        words.append(Str(rng.choice(["lorem", "ipsum", "dolor", "sit", "amet"])))
+    return words
+
+
+def _caption(rng, text):
+    return Caption(Plain(Str(text), Space(), *_words(rng, rng.randint(1, 6))))
+
+
+class DocumentGenerator:
+    def __init__(self, seed=0, missing_ratio=0.0, max_rows=5, references="text"):
+        self.rng = random.Random(seed)
+        # Where the cross references are: "text" (in paragraphs), "captions" (only in the captions of figures) or "none"
+        self.references = references
+        # Ratio of references pointing to labels which do not exist
+        self.missing_ratio = missing_ratio
+        # Maximum number of rows of multiline equations
+        self.max_rows = max_rows
+        self.labels = []
+        self.counter = 0
+
+    def _new_label(self, prefix):
+        self.counter += 1
+        label = f"{prefix}:{self.counter}"
+        self.labels.append(label)
+        return label
+
+    def equation(self):
+        label = self._new_label("eq")
+        return Para(
+            Math(
+                f"\\begin{{equation}}\na+b=c\\label{{{label}}}\n\\end{{equation}}",
+                format="DisplayMath",
+            )
+        )
+
+    def multiline_equation(self):
+        lines = []
+        for i in range(self.rng.randint(2, self.max_rows)):
+            if self.rng.random() < 0.2:
+                lines.append(f"x_{i} &= y_{i} \\nonumber")
+            else:
+                lines.append(f"x_{i} &= y_{i} \\label{{{self._new_label('eq')}}}")
+        body = "\\\\\n".join(lines)
+        return Para(
+            Math(f"\\begin{{align}}\n{body}\n\\end{{align}}", format="DisplayMath")
+        )
+
+    def figure(self):
+        rng = self.rng
+        label = self._new_label("fig") if rng.random() < 0.8 else ""
+        image = Plain(Image(url="image.png"))
+        subfigure_count = rng.choice([0, 0, 2, 3])
+        if subfigure_count:
+            content = [
+                Figure(
+                    image,
+                    caption=_caption(rng, "Subfigure"),
+                    identifier=self._new_label("fig"),
+                )
+                for _ in range(subfigure_count)
+            ]
+        else:
+            content = [image]
+        caption = _caption(rng, "Figure")
+        if self.references == "captions" and self.labels:
+            caption.content[0].content.extend([Space(), self.reference()])
+        return Figure(*content, caption=caption, identifier=label)
+
+    def table(self):
+        rng = self.rng
+        body = TableBody(
+            *[
+                TableRow(*[TableCell(Plain(Str(f"{i}{j}"))) for j in range(3)])
+                for i in range(3)
+            ]
+        )
+        table = Table(body, caption=_caption(rng, "Table"))
+        # Like the pandoc reader, labelled tables are wrapped into a div holding the label
+        if rng.random() < 0.8:
+            return Div(table, identifier=self._new_label("tab"))
+        return table
+
+    def theorem(self):
+        rng = self.rng
+        thm_type = rng.choice(THEOREM_NAMES)
+        label = self._new_label("thm") if rng.random() < 0.8 else ""
+        return Div(
+            Para(*_words(rng, rng.randint(5, 20))),
+            identifier=label,
+            classes=[thm_type],
+        )
+
+    def reference(self):
+        rng = self.rng
+        labels = [
+            (
+                f"missing:{rng.randint(0, 10**6)}"
+                if rng.random() < self.missing_ratio
+                else rng.choice(self.labels)
+            )
+            for _ in range(rng.choice([1, 1, 1, 2, 3]))
+        ]
+        return Link(
+            Str(f"[{labels[0]}]"),
+            url=f"#{labels[0]}",
+            attributes={
+                "reference-type": rng.choice(REFERENCE_TYPES),
+                "reference": ",".join(labels),
+            },
+        )
+
+    def paragraph(self):
+        rng = self.rng
+        content = _words(rng, rng.randint(5, 30))
+        if self.labels and self.references == "text":
+            for _ in range(rng.randint(0, 3)):
+                content.extend([Space(), self.reference()])
+        return Para(*content)
+
+    def section(self, level, items):
+        rng = self.rng
+        blocks = [
+            Header(
+                *_words(rng, rng.randint(1, 4)),
+                level=level,
+                identifier=self._new_label("sec"),
+            )
+        ]
+        makers = [
+            self.paragraph,
+            self.paragraph,
+            self.equation,
+            self.multiline_equation,
+            self.figure,
+            self.table,
+            self.theorem,
+        ]
+        for _ in range(items):
+            blocks.append(rng.choice(makers)())
+        return blocks
+
+    def blocks(self, sections, items_per_section):
+        blocks = []
+        for _ in range(sections):
+            blocks.extend(self.section(1, items_per_section))
+            for _ in range(self.rng.randint(0, 3)):
+                blocks.extend(self.section(2, items_per_section))
+        return blocks
+
+
+def make_doc(
+    sections=10,
+    items_per_section=20,
+    seed=0,
+    output_format="html",
+    metadata=None,
+    missing_ratio=0.0,
+    max_rows=5,
+    references="text",
+):
+    generator = DocumentGenerator(
+        seed=seed,
+        missing_ratio=missing_ratio,
+        max_rows=max_rows,
+        references=references,
+    )
+    doc = Doc(*generator.blocks(sections, items_per_section), format=output_format)
+    doc.metadata = MetaMap()
+    doc.metadata["theorem-names"] = ",".join(THEOREM_NAMES)
+    for key, value in (metadata or {}).items():
+        doc.metadata[key] = value
+    return doc
@@ -0,0 +1,92 @@
+"""
+Module for the numbering artifact: the format-independent results of a filter run, saved to a sidecar file so that the runs on the same input for other output formats skip the numbering.
+
+When the environment variable `PANDOC_TEX_NUMBERING_ARTIFACT` is set to a file path, a run of the command line filter saves there:
+
+- a header line: the hash of the input AST (and of the filter version), the label data, the referenced labels, the items of the lists of figures and tables, the diagnostics and the counters of the run, and the paths of the elements which the format-specific steps change (paragraphs and tables wrapped into divs, caption numbers turned into links);
+- the numbered document before the format-specific steps, as a JSON AST.
+
+A later run whose input has the same hash loads the saved document instead of the input and applies only the format-specific steps, the numbering, the math parsing and the formatting are skipped. Any other input replaces the artifact. The header is read and checked before the saved document, a stale artifact costs one line.
+"""
+
+import hashlib
+import json
+import os
+
+from .cache import package_digest
+
+ARTIFACT_VERSION = 1
+# The environment variable holding the path of the artifact
+ARTIFACT_ENV = "PANDOC_TEX_NUMBERING_ARTIFACT"
+
+
+def element_path(elem, positions=None):
+    # Path from the document to the element: one (attribute name or None for `content`, index or None for an element held directly by the attribute) per level. `positions` caches the positions of the items of the containers already seen (by ids, comparing panflute elements is a deep comparison), it is shared by the calls on one document.
+    positions = {} if positions is None else positions
+    path = []
+    while not elem.parent is None:
+        container = elem.container
+        if container is None:
+            path.append([elem.location, None])
+        else:
+            container_positions = positions.get(id(container))
+            if container_positions is None:
+                container_positions = {
+                    id(item): idx for idx, item in enumerate(container.list)
+                }
+                positions[id(container)] = container_positions
+            path.append([elem.location, container_positions[id(elem)]])
+        elem = elem.parent
+    return path[::-1]
+
+
+def resolve_path(doc, path):
+    elem = doc
+    for location, idx in path:
+        if idx is None:
+            elem = getattr(elem, location)
+        else:
+            container = elem.content if location is None else getattr(elem, location)
+            elem = container[idx]
+    return elem
+
+
+class NumberingArtifact:
+    def __init__(self, path, input_hash):
+        self.path = path
+        self.input_hash = input_hash
+
+    def __repr__(self):
+        return f"NumberingArtifact({self.path})"
+
+    @classmethod
+    def from_env(cls, raw_input, environ=None):
+        # The artifact is configured by the environment, like the result cache: it is checked before the input is loaded
+        environ = os.environ if environ is None else environ
+        path = environ.get(ARTIFACT_ENV)
+        if not path:
+            return None
+        digest = hashlib.sha256(package_digest().encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(raw_input)
+        return cls(path, digest.hexdigest())
+
+    def load(self):
+        # Returns (header, document JSON AST) or None if the artifact is missing, unreadable or made from another input
+        try:
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline())
+                if (
+                    header.get("version") != ARTIFACT_VERSION
+                    or header.get("input_hash") != self.input_hash
+                ):
+                    return None
+                ast_json = f.read()
+        except (OSError, ValueError):
+            return None
+        return header, ast_json
+
+    def encode(self, header, ast_json, codec):
+        # Compact JSON has no raw newlines, the header is the first line of the file. The chunks are written one after the other, the document is not copied.
+        header = {"version": ARTIFACT_VERSION, "input_hash": self.input_hash, **header}
+        return (codec.dumps(header) + b"\n", ast_json)
@@ -0,0 +1,182 @@
+"""
+Module for the caches of the filter.
+
+- `LRUCache`: in-memory caches shared by all the runs of a process (e.g. a service calling `number_document` many times), they are bounded and safe to use from several threads.
+- `ResultCache`: an on-disk cache of whole filter runs, shared by all the processes using the same cache directory.
+
+`write_atomic` replaces files atomically, for the files read by other processes.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # A bounded mapping which evicts the least recently used entries. Cached values must never be modified by the callers.
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"LRUCache({len(self.data)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses)"
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_or_compute(self, key, compute):
+        # Returns (value, hit). The value is computed outside the lock, two threads missing the same key at once may both compute it.
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key], True
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value, False
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def write_atomic(path, data, mode=0o644):
+    # Readers see either the previous file or the complete new one: the data is written to a temporary file in the same directory, then renamed. `data` is bytes or an iterable of byte chunks, which are written one by one.
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                for chunk in data:
+                    f.write(chunk)
+        # Temporary files are only readable by their owner, the file is read by other processes (e.g. a metrics collector)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+_package_digest = None
+
+
+def package_digest():
+    # Digest of the package version and of its source files, so that any change of the filter invalidates the cached results
+    global _package_digest
+    if _package_digest is None:
+        try:
+            from importlib.metadata import version
+
+            package_version = version("pandoc-tex-numbering")
+        except Exception:
+            package_version = "unknown"
+        digest = hashlib.sha256(package_version.encode("utf-8"))
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package_dir)):
+            if name.endswith(".py"):
+                with open(os.path.join(package_dir, name), "rb") as f:
+                    digest.update(name.encode("utf-8"))
+                    digest.update(f.read())
+        _package_digest = digest.hexdigest()
+    return _package_digest
+
+
+class ResultCache:
+    # Every entry is made of two files: `<key>.exports.json` (the contents of the exported data files, by path, and the label diagnostics of the run, reported again on hits) and `<key>.ast` (the output AST). The AST file is written last, an entry is complete only if it exists.
+    # The modification time of the AST file is the last use of the entry, the least recently used entries are evicted when the cache exceeds `max_size` bytes.
+    def __init__(self, directory, max_size=512 * 2**20):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"ResultCache({self.directory})"
+
+    @classmethod
+    def from_env(cls, environ=None):
+        # The cache is only enabled by environment variables: it is checked before the document (and thus its metadata) is loaded
+        environ = os.environ if environ is None else environ
+        directory = environ.get("PANDOC_TEX_NUMBERING_CACHE_DIR")
+        if not directory:
+            return None
+        max_size = float(environ.get("PANDOC_TEX_NUMBERING_CACHE_SIZE", 512)) * 2**20
+        return cls(directory, int(max_size))
+
+    def key(self, raw_input, output_format):
+        # The metadata (including the command line metadata) is part of the input AST
+        digest = hashlib.sha256()
+        for part in [package_digest(), output_format]:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(raw_input)
+        return digest.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def get(self, key):
+        # Returns (output, exports, diagnostics) or None. Entries may be evicted by other processes at any time, which is handled as a miss.
+        try:
+            with open(self._path(key, ".ast"), "rb") as f:
+                output = f.read()
+            with open(self._path(key, ".exports.json"), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(self._path(key, ".ast"))
+            exports, diagnostics = entry["exports"], entry["diagnostics"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return output, exports, diagnostics
+
+    def put(self, key, output, exports, diagnostics=None):
+        # `diagnostics` is the dict of `Diagnostics.to_dict`
+        exports_data = json.dumps(
+            {"exports": exports, "diagnostics": diagnostics or {}}, ensure_ascii=False
+        ).encode("utf-8")
+        write_atomic(self._path(key, ".exports.json"), exports_data)
+        write_atomic(self._path(key, ".ast"), output)
+
+    def evict(self):
+        # Returns (number of entries, total size, number of evicted entries) after the eviction
+        entries = {}
+        for name in os.listdir(self.directory):
+            # Temporary files are entries being written by other processes
+            if name.endswith(".tmp"):
+                continue
+            key, _, suffix = name.partition(".")
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entry = entries.setdefault(key, [0, 0])
+            entry[0] += stat.st_size
+            if suffix == "ast":
+                entry[1] = stat.st_mtime
+        total_size = sum(size for size, _ in entries.values())
+        evicted = 0
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total_size <= self.max_size:
+                break
+            for suffix in [".ast", ".exports.json"]:
+                try:
+                    os.unlink(self._path(key, suffix))
+                except OSError:
+                    pass
+            total_size -= size
+            evicted += 1
+        return len(entries) - evicted, total_size, evicted
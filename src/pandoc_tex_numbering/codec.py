@@ -0,0 +1,109 @@
+"""
+Module for the JSON codecs of the filter I/O: the JSON AST read from pandoc and written back, and the data export.
+
+`orjson` is used for encoding when it is installed, since it is faster than the standard library (more than ten times on the data export), otherwise the standard library is used. Documents are always decoded by the standard library: panflute builds its elements in an object hook, which the C decoder of the standard library calls directly while orjson has none, and a second pass over the decoded tree costs more than orjson saves (see `benchmarks/bench_json.py`). The codec can be forced with the environment variable `PANDOC_TEX_NUMBERING_JSON_CODEC` (`stdlib` or `orjson`). Both codecs give the same documents and the same exported data.
+
+Decoding or encoding a large document allocates millions of objects which all stay alive, so the collections of the cyclic garbage collector triggered meanwhile take most of the time and cannot free anything. The command line filter pauses the collector around its own decoding and encoding with `paused_gc`. The codecs themselves never touch the collector: its state is global to the process, and the codecs are also used by library calls, possibly from several threads of a host which manages the collector itself.
+"""
+
+import gc
+import json
+import os
+from contextlib import contextmanager
+
+from panflute import Doc
+from panflute.elements import from_json
+
+
+@contextmanager
+def paused_gc():
+    # Only for single threaded programs owning the process, i.e. the command line filter
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def element_to_json(elem):
+    return elem.to_json()
+
+
+class StdlibCodec:
+    name = "stdlib"
+
+    def __repr__(self):
+        return "StdlibCodec()"
+
+    def load_doc(self, data):
+        # `data` is the whole JSON AST (bytes or str)
+        doc = json.loads(data, object_hook=from_json)
+        assert isinstance(doc, Doc), "The input is not a pandoc document"
+        return doc
+
+    def dumps(self, obj, indent=False):
+        # Returns UTF-8 bytes: compact like pandoc, or indented by 2 spaces. Panflute elements are serialized by their `to_json`.
+        if indent:
+            text = json.dumps(
+                obj, default=element_to_json, indent=2, ensure_ascii=False
+            )
+        else:
+            text = json.dumps(
+                obj,
+                default=element_to_json,
+                check_circular=False,
+                separators=(",", ":"),
+                ensure_ascii=False,
+            )
+        return text.encode("utf-8")
+
+
+class OrjsonCodec:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+        # Decoding, and encoding of objects nested deeper than the limit of orjson, are done by the standard library
+        self.fallback = StdlibCodec()
+
+    def __repr__(self):
+        return "OrjsonCodec()"
+
+    def load_doc(self, data):
+        return self.fallback.load_doc(data)
+
+    def dumps(self, obj, indent=False):
+        option = self.orjson.OPT_INDENT_2 if indent else 0
+        try:
+            return self.orjson.dumps(obj, default=element_to_json, option=option)
+        except self.orjson.JSONEncodeError:
+            return self.fallback.dumps(obj, indent)
+
+
+CODECS = {"stdlib": StdlibCodec, "orjson": OrjsonCodec}
+
+
+def get_codec(name=None):
+    # `name` is one of CODECS or "auto" (orjson if installed), by default it is read from the environment
+    name = name or os.environ.get("PANDOC_TEX_NUMBERING_JSON_CODEC", "auto")
+    if name == "auto":
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return StdlibCodec()
+    assert name in CODECS, f"Unknown JSON codec: {name}, must be one of {list(CODECS)}"
+    return CODECS[name]()
+
+
+def available_codecs():
+    codecs = []
+    for codec_class in CODECS.values():
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            pass
+    return codecs
@@ -0,0 +1,111 @@
+"""
+Module for the reverse-dependency index of multi-document projects.
+
+Every document converted with the metadata `dependency-export` writes a dependency file next to its data export (`<data-export-path without extension>.deps.json`), recording the labels it defines and the labels it references, with their rendered values. Comparing the dependency files of a project before and after some documents are rebuilt tells which other documents cite changed labels and need to be converted again:
+
+    pandoc-tex-numbering-deps OLD_DIR NEW_DIR
+
+This module is independent of pandoc and panflute, so that the command starts fast.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+DEPS_SUFFIX = ".deps.json"
+
+
+def dependency_path(data_export_path):
+    return os.path.splitext(data_export_path)[0] + DEPS_SUFFIX
+
+
+def build_dependency_record(ref_index, referenced_labels, presets):
+    # `ref_index` is the exported label data (label -> dict with the item type and the rendered presets), `referenced_labels` maps the labels referenced in the document to their number of references
+    defines = {
+        label: {key: data[key] for key in ["item_type", *presets]}
+        for label, data in ref_index.items()
+    }
+    references = {label: defines.get(label) for label in sorted(referenced_labels)}
+    return {"defines": defines, "references": references}
+
+
+def load_index(root):
+    # document name (path of the dependency file relative to `root`, without the suffix) -> dependency record
+    if os.path.isfile(root):
+        with open(root, "r", encoding="utf-8") as f:
+            return {os.path.basename(root)[: -len(DEPS_SUFFIX)]: json.load(f)}
+    index = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(DEPS_SUFFIX):
+                continue
+            path = os.path.join(dirpath, filename)
+            document = os.path.relpath(path, root)[: -len(DEPS_SUFFIX)]
+            with open(path, "r", encoding="utf-8") as f:
+                index[document] = json.load(f)
+    return index
+
+
+def project_definitions(index):
+    # label -> rendered values of all its definitions in the project (usually one)
+    definitions = {}
+    for document in sorted(index):
+        for label, values in index[document]["defines"].items():
+            definitions.setdefault(label, []).append(values)
+    return definitions
+
+
+def changed_labels(old_index, new_index):
+    old_definitions = project_definitions(old_index)
+    new_definitions = project_definitions(new_index)
+    return {
+        label
+        for label in set(old_definitions) | set(new_definitions)
+        if old_definitions.get(label) != new_definitions.get(label)
+    }
+
+
+def stale_documents(old_index, new_index):
+    # Documents which reference a changed label defined in another document. The labels of a document itself are rendered again whenever the document is rebuilt.
+    # Returns {document: sorted changed labels it references}
+    changed = changed_labels(old_index, new_index)
+    stale = {}
+    for document, record in new_index.items():
+        # The references recorded before the change, a document which was rebuilt in the meantime has its new references in the new index
+        references = set(record["references"])
+        if document in old_index:
+            references |= set(old_index[document]["references"])
+        labels = sorted(
+            label for label in references & changed if not label in record["defines"]
+        )
+        if labels:
+            stale[document] = labels
+    return stale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pandoc-tex-numbering-deps",
+        description="List the documents which need to be converted again because labels they reference have changed, by comparing two sets of dependency files (directories or single files).",
+    )
+    parser.add_argument("old", help="dependency files before the change")
+    parser.add_argument("new", help="dependency files after the change")
+    parser.add_argument(
+        "--labels",
+        action="store_true",
+        help="also print the changed labels referenced by every document",
+    )
+    args = parser.parse_args(argv)
+
+    stale = stale_documents(load_index(args.old), load_index(args.new))
+    for document, labels in sorted(stale.items()):
+        if args.labels:
+            print(f"{document}\t{','.join(labels)}")
+        else:
+            print(document)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Module for collecting label problems (missing, duplicate, empty and unused labels) and other degraded results (equations numbered as a whole because they are too costly to parse) during a filter run.
+
+Problems are aggregated by kind and label: every problem keeps its number of occurrences and the location of its first occurrence, and the whole collection is reported once at the end of the run instead of logging every occurrence.
+"""
+
+import logging
+
+logger = logging.getLogger("pandoc-tex-numbering")
+
+# Kinds of problems which stop the filter in strict mode. Unused labels are only informative.
+STRICT_KINDS = ["missing", "duplicate", "empty"]
+# Kinds of problems which are listed one by one in the report, the others are only counted
+DETAILED_KINDS = STRICT_KINDS + ["fallback"]
+KIND_DESCRIPTIONS = {
+    "missing": "Reference not found",
+    "duplicate": "Duplicate label",
+    "empty": "Empty label",
+    "unused": "Unused label",
+    "fallback": "Equation numbered as a whole",
+}
+
+
+class LabelError(ValueError):
+    pass
+
+
+class Diagnostics:
+    def __init__(self, strict=False):
+        self.strict = strict
+        # (kind, label) -> [count, location of the first occurrence]
+        self.problems = {}
+
+    def __repr__(self):
+        return f"Diagnostics({len(self.problems)} problems)"
+
+    def record(self, kind, label, location=None):
+        # `location` can be a callable, it is only evaluated for the first occurrence of a problem
+        key = (kind, label)
+        if key in self.problems:
+            self.problems[key][0] += 1
+            return
+        if callable(location):
+            location = location()
+        if self.strict and kind in STRICT_KINDS:
+            raise LabelError(f"{KIND_DESCRIPTIONS[kind]}: '{label}' at {location}")
+        self.problems[key] = [1, location]
+
+    def of_kind(self, kind):
+        return [
+            {"label": label, "count": count, "location": location}
+            for (this_kind, label), (count, location) in self.problems.items()
+            if this_kind == kind
+        ]
+
+    def to_dict(self):
+        return {kind: self.of_kind(kind) for kind in KIND_DESCRIPTIONS}
+
+    @classmethod
+    def from_dict(cls, data, strict=False):
+        # The inverse of `to_dict`, e.g. for the diagnostics saved in a numbering artifact
+        diagnostics = cls(strict=strict)
+        for kind, problems in data.items():
+            for problem in problems:
+                diagnostics.problems[(kind, problem["label"])] = [
+                    problem["count"],
+                    problem["location"],
+                ]
+        return diagnostics
+
+    def report(self):
+        # All the problems are reported in one single log record
+        lines = []
+        counts = []
+        for kind, description in KIND_DESCRIPTIONS.items():
+            problems = self.of_kind(kind)
+            if not problems:
+                continue
+            counts.append(f"{len(problems)} {kind}")
+            if kind in DETAILED_KINDS:
+                for problem in problems:
+                    lines.append(
+                        f"  {description}: '{problem['label']}' ({problem['count']} times, first at {problem['location']})"
+                    )
+        if not counts:
+            return
+        summary = f"Label diagnostics: {', '.join(counts)}"
+        if lines:
+            logger.warning("\n".join([summary, *lines]))
+        else:
+            logger.info(summary)
@@ -13,38 +13,39 @@ def _from_seq(seq,num,zero_str="0"):
     nums = _num2base(num-1,len(seq))
     return "".join([seq[n] for n in nums])
 
+CHINESE_NUMERALS = "零一二三四五六七八九"
+CHINESE_UNITS = ["", "十", "百", "千", "万", "十", "百", "千", "亿"]
+
 def arabic2chinese(num):
-    chinese_numerals = "零一二三四五六七八九"
-    units = ["", "十", "百", "千", "万", "十", "百", "千", "亿"]
-    result = ""
     num_str = str(num)
     length = len(num_str)
-    
-    for i in range(length):
-        digit = int(num_str[i])
+    pieces = []
+    for i,char in enumerate(num_str):
+        digit = ord(char) - 48
         if digit != 0:
-            result += chinese_numerals[digit] + units[length - i - 1]
-        else:
-            if not result.endswith("零"):
-                result += "零"
+            pieces.append(CHINESE_NUMERALS[digit] + CHINESE_UNITS[length - i - 1])
+        elif not pieces or pieces[-1] != "零":
+            pieces.append("零")
+    result = "".join(pieces)
     if result!="零":
         result = result.rstrip("零")
     if result.startswith("一十"):
         result = result[1:]
     return result
 
+# Roman numerals of every decimal digit: ones, tens and hundreds. Thousands are repeated "M"s.
+ROMAN_DIGITS = [
+    ["", "I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX"],
+    ["", "X", "XX", "XXX", "XL", "L", "LX", "LXX", "LXXX", "XC"],
+    ["", "C", "CC", "CCC", "CD", "D", "DC", "DCC", "DCCC", "CM"],
+]
+
 def arabic2upper_roman(num):
     if num == 0: return "0"
-    breaks = [1000,900,500,400,100,90,50,40,10,9,5,4,1]
-    numerals = ["M","CM","D","CD","C","XC","L","XL","X","IX","V","IV","I"]
-    result = ""
-    while num>0:
-        for b,n in zip(breaks,numerals):
-            if num >= b:
-                result += n
-                num -= b
-                continue
-    return result
+    thousands, rest = divmod(num, 1000)
+    hundreds, rest = divmod(rest, 100)
+    tens, ones = divmod(rest, 10)
+    return "M"*thousands + ROMAN_DIGITS[2][hundreds] + ROMAN_DIGITS[1][tens] + ROMAN_DIGITS[0][ones]
 
 def arabic2lower_roman(num):
     return arabic2upper_roman(num).lower()
@@ -73,14 +74,37 @@ def arabic2upper_cyrillic(num):
     upper_cyrillic_numerals = "АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
     return _from_seq(upper_cyrillic_numerals,num)
 
-language_functions = {
-    "zh": arabic2chinese,
-    "Roman": arabic2upper_roman,
-    "roman": arabic2lower_roman,
-    "latin": arabic2lower_latin,
-    "Latin": arabic2upper_latin,
-    "greek": arabic2lower_greek,
-    "Greek": arabic2upper_greek,
-    "cyrillic": arabic2lower_cyrillic,
-    "Cyrillic": arabic2upper_cyrillic
-}
\ No newline at end of file
+# Numbers below this size (which covers nearly every real section, figure or equation number) are memoized in a lookup table per style
+TABLE_SIZE = 1024
+
+class CachedNumeral:
+    # Wraps a conversion function with a lookup table, the table is filled lazily on first use of every number
+    def __init__(self,func,table_size=TABLE_SIZE):
+        self.func = func
+        self.table = [None]*table_size
+
+    def __repr__(self):
+        return f"CachedNumeral({self.func.__name__})"
+
+    def __call__(self,num):
+        if 0 <= num < len(self.table):
+            result = self.table[num]
+            if result is None:
+                result = self.table[num] = self.func(num)
+            return result
+        return self.func(num)
+
+language_functions = {}
+
+def register_language(name,func,table_size=TABLE_SIZE):
+    language_functions[name] = CachedNumeral(func,table_size)
+
+register_language("zh",arabic2chinese)
+register_language("Roman",arabic2upper_roman)
+register_language("roman",arabic2lower_roman)
+register_language("latin",arabic2lower_latin)
+register_language("Latin",arabic2upper_latin)
+register_language("greek",arabic2lower_greek)
+register_language("Greek",arabic2upper_greek)
+register_language("cyrillic",arabic2lower_cyrillic)
+register_language("Cyrillic",arabic2upper_cyrillic)
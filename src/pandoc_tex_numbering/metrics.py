@@ -0,0 +1,171 @@
+"""
+Module for the Prometheus metrics of the command line filter.
+
+When the environment variable `PANDOC_TEX_NUMBERING_METRICS_FILE` is set, every run of the filter adds its counters and phase durations to this file, in the Prometheus text format read by the textfile collector of node-exporter. The file is read, merged and replaced atomically under an exclusive lock, so that concurrent filter processes on one host aggregate into the same file and the collector never sees a partial file.
+"""
+
+import os
+import re
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, the merge is not locked there
+    fcntl = None
+
+from .cache import write_atomic
+
+PREFIX = "pandoc_tex_numbering_"
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# name -> (type, help)
+FAMILIES = {
+    "documents_total": ("counter", "Documents processed by the filter."),
+    "labels_total": ("counter", "Labels defined, by item type."),
+    "references_total": ("counter", "References to labels, by resolution status."),
+    "equations_total": ("counter", "Display math blocks numbered, by numbering path."),
+    "math_parses_total": (
+        "counter",
+        "Multiline math blocks parsed with LatexWalker (cache miss) or taken from the parse cache (cache hit).",
+    ),
+    "elements_total": (
+        "counter",
+        "Candidate elements found by the census of the first walk, by kind.",
+    ),
+    "passes_skipped_total": (
+        "counter",
+        "Passes skipped because the census found nothing for them to do.",
+    ),
+    "phase_duration_seconds": ("histogram", "Duration of the phases of the filter."),
+}
+SAMPLE_PATTERN = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for key, value in labels.items()
+    }
+    return "{" + ",".join(f'{key}="{escaped[key]}"' for key in sorted(escaped)) + "}"
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def run_samples(metrics, cache):
+    # (sample name, labels) -> increment of one run. `metrics` is the dict built by `collect_metrics`, only its `format` is given for result cache hits.
+    samples = {}
+
+    def add(name, labels, value):
+        key = (PREFIX + name, format_labels(labels))
+        samples[key] = samples.get(key, 0) + value
+
+    add("documents_total", {"format": metrics["format"], "cache": cache}, 1)
+    for item_type, count in metrics.get("labels", {}).items():
+        add("labels_total", {"item_type": item_type}, count)
+    for status, count in metrics.get("references", {}).items():
+        add("references_total", {"status": status}, count)
+    for path, count in metrics.get("equations", {}).items():
+        add("equations_total", {"path": path}, count)
+    for result, count in metrics.get("math_parses", {}).items():
+        add("math_parses_total", {"cache": result}, count)
+    for kind, count in metrics.get("census", {}).items():
+        add("elements_total", {"kind": kind}, count)
+    for phase in metrics.get("skipped_passes", []):
+        add("passes_skipped_total", {"pass": phase}, 1)
+    for phase, duration in metrics.get("durations", {}).items():
+        # Buckets are cumulative, every run adds 0 or 1 to every bucket
+        for bound in DURATION_BUCKETS:
+            add(
+                "phase_duration_seconds_bucket",
+                {"phase": phase, "le": f"{bound:g}"},
+                int(duration <= bound),
+            )
+        add("phase_duration_seconds_bucket", {"phase": phase, "le": "+Inf"}, 1)
+        add("phase_duration_seconds_sum", {"phase": phase}, duration)
+        add("phase_duration_seconds_count", {"phase": phase}, 1)
+    return samples
+
+
+def parse_samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = SAMPLE_PATTERN.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[(name, labels or "")] = float(value)
+    return samples
+
+
+def family_of(name):
+    base = name[len(PREFIX) :] if name.startswith(PREFIX) else name
+    for suffix in ["_bucket", "_sum", "_count"]:
+        if base.endswith(suffix) and base[: -len(suffix)] in FAMILIES:
+            return base[: -len(suffix)]
+    return base
+
+
+def render(samples):
+    # Samples are grouped by family, with the HELP and TYPE lines of the known families
+    families = {}
+    for (name, labels), value in samples.items():
+        families.setdefault(family_of(name), []).append((name, labels, value))
+    lines = []
+    for family in sorted(families):
+        if family in FAMILIES:
+            metric_type, description = FAMILIES[family]
+            lines.append(f"# HELP {PREFIX}{family} {description}")
+            lines.append(f"# TYPE {PREFIX}{family} {metric_type}")
+        for name, labels, value in sorted(families[family], key=sample_order):
+            lines.append(f"{name}{labels} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def sample_order(sample):
+    # Histogram buckets are sorted by their upper bound, +Inf last
+    name, labels, _ = sample
+    match = re.search(r'le="([^"]*)"', labels)
+    bound = float("inf") if match is None else float(match.group(1))
+    return name, re.sub(r',?le="[^"]*"', "", labels), bound
+
+
+class MetricsSink:
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return f"MetricsSink({self.path})"
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        path = environ.get("PANDOC_TEX_NUMBERING_METRICS_FILE")
+        return cls(path) if path else None
+
+    @contextmanager
+    def _lock(self):
+        # The lock is held on a separate file, the metrics file itself is replaced by every writer
+        with open(self.path + ".lock", "a") as lock_file:
+            if not fcntl is None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if not fcntl is None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def record(self, metrics, cache="off"):
+        increments = run_samples(metrics, cache)
+        with self._lock():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    samples = parse_samples(f.read())
+            except FileNotFoundError:
+                samples = {}
+            for key, value in increments.items():
+                samples[key] = samples.get(key, 0) + value
+            write_atomic(self.path, render(samples).encode("utf-8"))
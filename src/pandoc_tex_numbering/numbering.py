@@ -1,6 +1,5 @@
 from .lang_num import language_functions
 import logging
-from copy import deepcopy
 
 logger = logging.getLogger("pandoc-tex-numbering")
 
@@ -15,8 +14,15 @@ def header_fields(header_nums):
 
 
 def nums2fields(
-    nums, item_type, num_style="arabic", prefix=None, pref_space=True, parent=None
+    nums,
+    item_type,
+    num_style="arabic",
+    prefix=None,
+    pref_space=True,
+    parent=None,
+    section_fields=None,
 ):
+    # `section_fields` are the header fields of the section prefix of the item (see `NumberingState.section_fields`), they are computed here if not given
     parent_num = parent.ref if not parent is None else ""
     if num_style == "arabic":
         this_num = str(nums[-1])
@@ -38,13 +44,17 @@ def nums2fields(
     if item_type in ["sec", "apx"]:
         add_fields = header_fields(nums)
     elif item_type == "subfig":
+        if section_fields is None:
+            section_fields = header_fields(nums[:-2])
         add_fields = {
             "fig_id": str(nums[-2]),
             "subfig_id": str(nums[-1]),
-            **header_fields(nums[:-2]),
+            **section_fields,
         }
     else:
-        add_fields = {f"{item_type}_id": str(nums[-1]), **header_fields(nums[:-1])}
+        if section_fields is None:
+            section_fields = header_fields(nums[:-1])
+        add_fields = {f"{item_type}_id": str(nums[-1]), **section_fields}
     return {**common_fields, **add_fields}
 
 
@@ -61,38 +71,89 @@ class Formater:
     def __repr__(self):
         return f"Formater({self.item_type})"
 
-    def __call__(self, nums, fmt_preset=None, fmt=None, parent=None):
+    def fields(self, nums, parent=None, section_fields=None):
+        return nums2fields(
+            nums,
+            self.item_type,
+            self.num_style,
+            self.prefix,
+            self.pref_space,
+            parent,
+            section_fields,
+        )
+
+    def __call__(self, nums, fmt_preset=None, fmt=None, parent=None, fields=None):
+        # `fields` can be given to reuse the fields already computed for the same item
         if not fmt_preset is None:
             assert fmt_preset in self.fmt_presets, f"Invalid format type: {fmt_preset}"
             fmt = self.fmt_presets[fmt_preset]
         if fmt is None:
             if fmt_preset == "Cref":
-                cref = self(nums, fmt_preset="cref", parent=parent)
+                cref = self(nums, fmt_preset="cref", parent=parent, fields=fields)
                 return f"{cref[0].upper()}{cref[1:]}"
             elif fmt_preset == "src":
-                return self(nums, fmt_preset="Cref", parent=parent)
+                return self(nums, fmt_preset="Cref", parent=parent, fields=fields)
             else:
                 raise ValueError("No valid format provided")
-        fields = nums2fields(
-            nums, self.item_type, self.num_style, self.prefix, self.pref_space, parent
-        )
         if isinstance(fmt, str):
+            if fields is None:
+                fields = self.fields(nums, parent)
             return fmt.format(**fields)
         elif callable(fmt):
             return fmt(nums)
 
 
+class LazyFormaters:
+    # A mapping of Formater objects which are built by `factory` on first access and then cached
+    def __init__(self, factory):
+        self.factory = factory
+        self.formaters = {}
+
+    def __repr__(self):
+        return f"LazyFormaters({list(self.formaters)})"
+
+    def __getitem__(self, key):
+        formater = self.formaters.get(key)
+        if formater is None:
+            formater = self.formaters[key] = self.factory(key)
+        return formater
+
+
 class Numbering:
-    def __init__(self, item_type, nums, formater=None, parent=None):
+    def __init__(
+        self, item_type, nums, formater=None, parent=None, section_fields=None
+    ):
         self.item_type = item_type
         self.nums = nums
         self.formater = formater
         self.caption = None
         self.short_caption = None
         self.parent = parent
+        # Header fields shared by all the items of the same section, see `NumberingState.section_fields`
+        self.section_fields = section_fields
+        # A numbering never changes once created, so its fields and its formatted presets are computed at most once
+        self._fields = None
+        self._formatted = {}
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.formater.fields(
+                self.nums, self.parent, self.section_fields
+            )
+        return self._fields
 
     def format(self, fmt_preset=None, fmt=None):
-        return self.formater(self.nums, fmt_preset, fmt, self.parent)
+        if not fmt is None:
+            return self.formater(
+                self.nums, fmt=fmt, parent=self.parent, fields=self.fields
+            )
+        result = self._formatted.get(fmt_preset)
+        if result is None:
+            result = self._formatted[fmt_preset] = self.formater(
+                self.nums, fmt_preset, parent=self.parent, fields=self.fields
+            )
+        return result
 
     @property
     def src(self):
@@ -110,15 +171,14 @@ class Numbering:
     def Cref(self):
         return self.format(fmt_preset="Cref")
 
-    def to_dict(self):
+    def to_dict(self, presets=("src", "ref", "cref", "Cref")):
+        # Only the requested presets are rendered, formatting is the most expensive part of the export
         data = {
             "item_type": self.item_type,
             "nums": self.nums,
-            "src": self.src,
-            "ref": self.ref,
-            "cref": self.cref,
-            "Cref": self.Cref,
         }
+        for preset in presets:
+            data[preset] = self.format(fmt_preset=preset)
         if self.caption is not None:
             data["caption"] = self.caption
         if self.short_caption is not None:
@@ -154,89 +214,200 @@ class Numbering:
         return f"{self.item_type}: {'.'.join(map(str,self.nums))}"
 
 
+class CounterEngine:
+    # Integer counters stored in one flat list. Every counter declares the counters which reset it when they are stepped. The slots are laid out in depth-first order of the first resetting counter, so that the counters reset by a counter, directly or transitively, occupy a few contiguous ranges of slots (one in most cases), which are reset by one slice assignment each.
+    def __init__(self, counters):
+        # `counters` is a list of (name, reset_by, initial): `reset_by` is a list of counter names, `initial` is the value of the counter at the start and after every reset
+        self.declared = {
+            name: (list(reset_by), initial) for name, reset_by, initial in counters
+        }
+        children = {name: [] for name in self.declared}
+        roots = []
+        for name, (reset_by, _) in self.declared.items():
+            for parent in reset_by:
+                assert (
+                    parent in self.declared
+                ), f"Unknown counter {parent} resetting the counter {name}"
+            if reset_by:
+                children[reset_by[0]].append(name)
+            else:
+                roots.append(name)
+
+        order = []
+        stack = roots[::-1]
+        while stack:
+            name = stack.pop()
+            order.append(name)
+            stack.extend(children[name][::-1])
+        assert len(order) == len(
+            self.declared
+        ), f"Cyclic reset dependencies between the counters: {sorted(set(self.declared) - set(order))}"
+        self.slots = {name: slot for slot, name in enumerate(order)}
+        self.initial = [self.declared[name][1] for name in order]
+        self.values = list(self.initial)
+
+        # Slot -> list of (start, stop, initial values) of the counters reset by the counter, directly or transitively
+        reset_counters = {name: [] for name in order}
+        for name in order:
+            for parent in self.declared[name][0]:
+                reset_counters[parent].append(name)
+        self.resets = []
+        for name in order:
+            ranges = []
+            dependents = set()
+            stack = list(reset_counters[name])
+            while stack:
+                dependent = stack.pop()
+                if not dependent in dependents:
+                    dependents.add(dependent)
+                    stack.extend(reset_counters[dependent])
+            assert (
+                not name in dependents
+            ), f"Cyclic reset dependencies between the counters: {name} resets itself"
+            for slot in sorted(self.slots[dependent] for dependent in dependents):
+                if ranges and ranges[-1][1] == slot:
+                    ranges[-1][1] = slot + 1
+                else:
+                    ranges.append([slot, slot + 1])
+            self.resets.append(
+                [(start, stop, self.initial[start:stop]) for start, stop in ranges]
+            )
+
+    def __repr__(self):
+        return f"CounterEngine({dict(zip(self.slots, self.values))})"
+
+    def __contains__(self, name):
+        return name in self.slots
+
+    def __getitem__(self, name):
+        return self.values[self.slots[name]]
+
+    def step(self, slot):
+        values = self.values
+        values[slot] += 1
+        for start, stop, initial in self.resets[slot]:
+            values[start:stop] = initial
+
+
 class NumberingState:
+    # The numbering of the document on top of a `CounterEngine`: sections and appendices are counted per level, the items (equations, tables, figures, subfigures, theorems and custom environments) are counters named by their item type
     def __init__(
-        self, formaters: dict, reset_level=1, max_levels=10, offsets: dict = None
+        self,
+        formaters: dict,
+        reset_level=1,
+        max_levels=10,
+        offsets: dict = None,
+        theorem_names=(),
+        environments: dict = None,
     ):
-
+        # `offsets` maps counter names (e.g. "eq", "sec-2", "thm-lemma") to their initial values
+        # `environments` maps the names of custom environments to the counter resetting them: "section" (the sections of `reset_level`), None (never reset) or the name of another item counter, whose number is then a prefix of the number of the environment
+        offsets = offsets or {}
+        environments = environments or {}
         self.reset_level = reset_level
-        self.init_nums = {
-            "sec": [0] * max_levels,
-            "apx": [0] * max_levels,
-            "eq": 0,
-            "tab": 0,
-            "fig": 0,
-            "subfig": 0,
-            "thm": {},
-        }
-        for item, value in offsets.items():
-            value = int(value)
-            if item in ["eq", "tab", "fig", "subfig"]:
-                self.init_nums[item] = value
-                continue
-            item, info = item.split("_")
-            if item in ["sec", "apx"]:
-                idx = int(info) - 1
-                self.init_nums[item][idx] = value
-            elif item == "thm":
-                self.init_nums[item][info] = value
+        self.max_levels = max_levels
+        self.formaters = formaters
+
+        section_resets = []
+        if reset_level >= 1:
+            level = min(reset_level, max_levels)
+            section_resets = [f"sec-{level}", f"apx-{level}"]
+        counters = []
+        for series in ["sec", "apx"]:
+            for level in range(1, max_levels + 1):
+                counters.append(
+                    (f"{series}-{level}", [f"{series}-{level-1}"] if level > 1 else [])
+                )
+        # Item counter -> (formater mapping, key in the mapping, parent item counter or None)
+        self.items = {}
+        for item in ["eq", "tab", "fig"]:
+            counters.append((item, section_resets))
+            self.items[item] = (formaters, item, None)
+        counters.append(("subfig", ["fig"]))
+        self.items["subfig"] = (formaters, "subfig", "fig")
+        # Theorems are numbered continuously, with the section prefix
+        for thm_type in theorem_names:
+            counters.append((f"thm-{thm_type}", []))
+            self.items[f"thm-{thm_type}"] = (formaters["thm"], thm_type, None)
+        for name, reset_by in environments.items():
+            if reset_by == "section":
+                counters.append((name, section_resets))
+                self.items[name] = (formaters["env"], name, None)
+            elif reset_by is None:
+                counters.append((name, []))
+                self.items[name] = (formaters["env"], name, None)
             else:
+                counters.append((name, [reset_by]))
+                self.items[name] = (formaters["env"], name, reset_by)
+        for item, value in offsets.items():
+            if not any(name == item for name, _ in counters):
                 logger.warning(f"Invalid offset item: {item}, ignored")
-        logger.info(f"Initial numbering: {self.init_nums}")
-        self.nums = deepcopy(self.init_nums)
-        self.formaters = formaters
-        self.isin_apx = False
+        self.counters = CounterEngine(
+            [(name, reset_by, int(offsets.get(name, 0))) for name, reset_by in counters]
+        )
+        logger.info(f"Initial numbering: {self.counters}")
+        self.values = self.counters.values
+        self.slots = self.counters.slots
+        self.sec_slots = [
+            self.slots[f"sec-{level}"] for level in range(1, max_levels + 1)
+        ]
+        self.apx_slots = [
+            self.slots[f"apx-{level}"] for level in range(1, max_levels + 1)
+        ]
+        self._isin_apx = False
+        # Numbers and header fields of the current section prefix, built once when the prefix changes and shared by every item numbered inside it
+        self._section_nums = None
+        self._section_fields = None
 
         # We need to store the current numbering objects for each level since they're frequently accessed in the same level. We cannot create a new object each time considering the RAM usage.
         self.current_sec_objs = [None] * max_levels
         self.current_apx_objs = [None] * max_levels
 
-    def reset_nums(self, items):
-        for item in items:
-            self.nums[item] = deepcopy(self.init_nums[item])
+    @property
+    def isin_apx(self):
+        return self._isin_apx
+
+    @isin_apx.setter
+    def isin_apx(self, value):
+        if value != self._isin_apx:
+            self._section_nums = None
+            self._section_fields = None
+        self._isin_apx = value
+
+    @property
+    def section_fields(self):
+        if self._section_fields is None:
+            self._section_fields = header_fields(self.current_sec_nums)
+        return self._section_fields
 
     def next_sec(self, level):
         if self.isin_apx:
-            self.nums["apx"][level - 1] += 1
-            self.nums["apx"][level:] = deepcopy(self.init_nums["apx"][level:])
+            self.counters.step(self.apx_slots[level - 1])
             self.current_apx_objs[level - 1 :] = [None] * (
                 len(self.current_apx_objs) - level + 1
             )
         else:
-            self.nums["sec"][level - 1] += 1
-            self.nums["sec"][level:] = deepcopy(self.init_nums["sec"][level:])
+            self.counters.step(self.sec_slots[level - 1])
             self.current_sec_objs[level - 1 :] = [None] * (
                 len(self.current_sec_objs) - level + 1
             )
         if level <= self.reset_level:
-            self.reset_nums(["eq", "tab", "fig", "subfig"])
-
-    def next_eq(self):
-        self.nums["eq"] += 1
+            # Deeper sections do not change the prefix of the items
+            self._section_nums = None
+            self._section_fields = None
 
-    def next_tab(self):
-        self.nums["tab"] += 1
-
-    def next_fig(self):
-        self.nums["fig"] += 1
-        self.reset_nums(["subfig"])
-
-    def next_subfig(self):
-        self.nums["subfig"] += 1
-
-    def next_thm(self, thm_type):
-        if not thm_type in self.nums["thm"]:
-            self.nums["thm"][thm_type] = 1
-        else:
-            self.nums["thm"][thm_type] += 1
+    def next(self, item):
+        # Steps the counter of an item type, which resets the counters depending on it (e.g. subfigures for figures)
+        self.counters.step(self.slots[item])
 
     @property
     def current_sec_nums(self):
-        return (
-            deepcopy(self.nums["apx"][: self.reset_level])
-            if self.isin_apx
-            else deepcopy(self.nums["sec"][: self.reset_level])
-        )
+        if self._section_nums is None:
+            slots = self.apx_slots if self.isin_apx else self.sec_slots
+            self._section_nums = [
+                self.values[slot] for slot in slots[: self.reset_level]
+            ]
+        return self._section_nums
 
     def current_sec(self, level):
         if level <= 0:
@@ -244,63 +415,103 @@ class NumberingState:
         if self.isin_apx:
             item_type = "apx"
             obj_list = self.current_apx_objs
-            num_list = self.nums["apx"]
+            slots = self.apx_slots
         else:
             item_type = "sec"
             obj_list = self.current_sec_objs
-            num_list = self.nums["sec"]
+            slots = self.sec_slots
         if obj_list[level - 1] is None:
             obj_list[level - 1] = Numbering(
                 item_type,
-                num_list[:level],
+                [self.values[slot] for slot in slots[:level]],
                 self.formaters[item_type][level - 1],
                 parent=self.current_sec(level - 1),
             )
         return obj_list[level - 1]
 
-    def current_eq(self):
-        return Numbering(
-            "eq",
-            self.current_sec_nums + [self.nums["eq"]],
-            self.formaters["eq"],
-            parent=self.current_sec(self.reset_level),
-        )
-
-    def current_tab(self):
-        return Numbering(
-            "tab",
-            self.current_sec_nums + [self.nums["tab"]],
-            self.formaters["tab"],
-            parent=self.current_sec(self.reset_level),
-        )
-
-    def current_fig(self, subfig=False):
-        if subfig:
+    def current(self, item):
+        # The numbering of the current item of an item type, its number is prefixed by the section prefix, or by the number of its parent item (e.g. the figure of a subfigure)
+        formaters, key, parent_item = self.items[item]
+        value = self.values[self.slots[item]]
+        if parent_item is None:
             return Numbering(
-                "subfig",
-                self.current_sec_nums + [self.nums["fig"], self.nums["subfig"]],
-                self.formaters["subfig"],
-                parent=self.current_fig(False),
-            )
-        else:
-            return Numbering(
-                "fig",
-                self.current_sec_nums + [self.nums["fig"]],
-                self.formaters["fig"],
+                item,
+                self.current_sec_nums + [value],
+                formaters[key],
                 parent=self.current_sec(self.reset_level),
+                section_fields=self.section_fields,
             )
-
-    def current_thm(self, thm_type):
-        if not thm_type in self.nums["thm"]:
-            self.nums["thm"][thm_type] = 0
+        parent = self.current(parent_item)
         return Numbering(
-            f"thm-{thm_type}",
-            self.current_sec_nums + [self.nums["thm"][thm_type]],
-            self.formaters["thm"][thm_type],
-            parent=self.current_sec(self.reset_level),
+            item,
+            parent.nums + [value],
+            formaters[key],
+            parent=parent,
+            section_fields=self.section_fields,
         )
 
 
+class LabelRegistry:
+    # A mapping from labels to Numbering objects, which also keeps an index of labels per item type in document order
+    def __init__(self):
+        self.labels = {}
+        # item_type -> {label: Numbering}, so that iterating the items of one type does not need to scan all labels
+        self.by_type = {}
+        # label -> where the label is defined, or a callable describing it on first use (see `site`)
+        self.sites = {}
+        # label -> number of redefinitions
+        self.duplicates = {}
+        # labels generated automatically (by pandoc or by the filter)
+        self.implicit = set()
+
+    def __repr__(self):
+        return f"LabelRegistry({len(self.labels)} labels)"
+
+    def __contains__(self, label):
+        return label in self.labels
+
+    def __getitem__(self, label):
+        return self.labels[label]
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get(self, label, default=None):
+        return self.labels.get(label, default)
+
+    def items(self):
+        return self.labels.items()
+
+    def add(self, label, num_obj, site=None, implicit=False):
+        # Returns the previous Numbering object if the label is redefined (the later definition wins), otherwise None
+        previous = self.labels.get(label)
+        if previous is num_obj:
+            return None
+        if not previous is None:
+            self.duplicates[label] = self.duplicates.get(label, 0) + 1
+            if previous.item_type != num_obj.item_type:
+                del self.by_type[previous.item_type][label]
+        self.labels[label] = num_obj
+        self.by_type.setdefault(num_obj.item_type, {})[label] = num_obj
+        self.sites[label] = site
+        if implicit:
+            self.implicit.add(label)
+        return previous
+
+    def site(self, label):
+        # Describing a location walks the document, it is only done for the labels a diagnostic is about
+        site = self.sites[label]
+        if callable(site):
+            site = self.sites[label] = site()
+        return str(self.labels[label]) if site is None else site
+
+    def of_type(self, item_type):
+        return self.by_type.get(item_type, {}).items()
+
+
 def numberings2chunks(numberings, split_continous=True):
     numberings = sorted(numberings)
     chunks = {}
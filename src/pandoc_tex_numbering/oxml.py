@@ -47,7 +47,54 @@ class ElementProxy:
         return elm
     
     def to_string(self,encoding="utf-8"):
-        return ET.tostring(self.element,xml_declaration=False,encoding=encoding).decode()
+        if encoding.lower().replace("-","") != "utf8":
+            return ET.tostring(self.element,xml_declaration=False,encoding=encoding).decode()
+        # Write the escaped xml directly from the proxy tree into one buffer instead of building an ElementTree first. The output is the same as `ET.tostring(self.element)`.
+        # The tree is walked iteratively with an explicit stack (closing tags are pushed as strings), so deep trees cannot hit the recursion limit.
+        buffer = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node,str):
+                buffer.append(node)
+                continue
+            if not isinstance(node,ElementProxy):
+                buffer.append(ET.tostring(node,encoding=encoding).decode())
+                continue
+            buffer.append("<" + node.elem_name)
+            for k,v in node.attrs.items():
+                buffer.append(f' {k}="{_escape_attrib(v)}"')
+            if node.children or node.text:
+                buffer.append(">")
+                if node.text:
+                    buffer.append(_escape_cdata(node.text))
+                stack.append(f"</{node.elem_name}>")
+                stack.extend(reversed(node.children))
+            else:
+                buffer.append(" />")
+        return "".join(buffer)
+
+def _escape_cdata(text):
+    # Same escaping as ElementTree
+    if "&" in text:
+        text = text.replace("&","&amp;")
+    if "<" in text:
+        text = text.replace("<","&lt;")
+    if ">" in text:
+        text = text.replace(">","&gt;")
+    return text
+
+def _escape_attrib(text):
+    text = _escape_cdata(text)
+    if "\"" in text:
+        text = text.replace("\"","&quot;")
+    if "\r" in text:
+        text = text.replace("\r","&#13;")
+    if "\n" in text:
+        text = text.replace("\n","&#10;")
+    if "\t" in text:
+        text = text.replace("\t","&#09;")
+    return text
 
 # define some enums
 class Alignment(Enum):
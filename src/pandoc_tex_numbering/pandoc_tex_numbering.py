@@ -1,54 +1,204 @@
 import logging
+import os
 import re
-import json
 import string
+import sys
+import time
 import warnings
 
 from panflute import *
 from pylatexenc.latexwalker import LatexWalker, LatexEnvironmentNode, LatexMacroNode
 
+from .artifact import ARTIFACT_ENV, NumberingArtifact, element_path, resolve_path
+from .cache import LRUCache, ResultCache, write_atomic
+from .codec import get_codec, paused_gc
+from .deps import build_dependency_record, dependency_path
+from .diagnostics import Diagnostics
 from .docx_list import add_docx_list
-from .numbering import NumberingState, Formater, numberings2chunks
+from .metrics import MetricsSink
+from .writer import PROCESS_MIN_LABELS, ExportWriter
+from .numbering import (
+    NumberingState,
+    Formater,
+    LazyFormaters,
+    LabelRegistry,
+    numberings2chunks,
+)
 
 logger = logging.getLogger("pandoc-tex-numbering")
-hdlr = logging.FileHandler("pandoc-tex-numbering.log")
-formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-hdlr.setFormatter(formatter)
-logger.addHandler(hdlr)
+# Importing the module has no side effects: the log file is only opened by the command line entry (see `setup_log_file`)
+logger.addHandler(logging.NullHandler())
 logger.setLevel(logging.INFO)
 
 
-def to_string(elem):
-    if isinstance(elem, Str):
-        return elem.text
-    elif isinstance(elem, Space):
-        return " "
-    elif isinstance(elem, (LineBreak, SoftBreak)):
-        return "\n"
-    elif isinstance(elem, ListContainer):
-        return "".join([to_string(item) for item in elem])
-    elif hasattr(elem, "content"):
-        return "".join([to_string(item) for item in elem.content])
-    else:
-        return ""
+# Structures of multiline math blocks, keyed by the math string and the multiline environments (see `parse_latex_math`)
+MATH_STRUCTURE_CACHE = LRUCache(maxsize=1024)
+# Codec of the JSON AST and of the data export, see `codec.py`
+JSON_CODEC = get_codec()
+
+
+def setup_log_file(path="pandoc-tex-numbering.log"):
+    if any(isinstance(hdlr, logging.FileHandler) for hdlr in logger.handlers):
+        return
+    hdlr = logging.FileHandler(path)
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    hdlr.setFormatter(formatter)
+    logger.addHandler(hdlr)
 
 
-def extract_captions_from_refdict(ref_dict, ref_type, doc):
+def to_string(elem):
+    # The inline tree is walked iteratively with an explicit stack and the pieces are appended into one buffer, so that deeply nested elements cannot hit the recursion limit.
+    buffer = []
+    stack = [elem]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Str):
+            buffer.append(item.text)
+        elif isinstance(item, Space):
+            buffer.append(" ")
+        elif isinstance(item, (LineBreak, SoftBreak)):
+            buffer.append("\n")
+        elif isinstance(item, ListContainer):
+            stack.extend(reversed(item.list))
+        elif hasattr(item, "content"):
+            stack.append(item.content)
+    return "".join(buffer)
+
+
+def extract_captions(registry, ref_type):
     items = []
     assert ref_type in ["fig", "tab"]
-    for label, num_obj in ref_dict.items():
-        if num_obj.item_type == ref_type:
-            caption_body = (
-                num_obj.short_caption
-                if not num_obj.short_caption is None
-                else num_obj.caption
-            )
-            caption_ref = num_obj.src
-            caption = f"{caption_ref}: {caption_body}" if caption_body else caption_ref
-            items.append((caption, label))
+    for label, num_obj in registry.of_type(ref_type):
+        caption_body = (
+            num_obj.short_caption
+            if not num_obj.short_caption is None
+            else num_obj.caption
+        )
+        caption_ref = num_obj.src
+        caption = f"{caption_ref}: {caption_body}" if caption_body else caption_ref
+        items.append((caption, label))
     return items
 
 
+def build_ref_index(registry, presets=None):
+    return dict(iter_ref_index(registry, presets))
+
+
+def iter_ref_index(registry, presets=None):
+    # (label, label data) pairs, the data of every label is rendered when the pair is taken
+    presets = presets or ["src", "ref", "cref", "Cref"]
+    return ((label, num_obj.to_dict(presets)) for label, num_obj in registry.items())
+
+
+def encode_ref_index(ref_index, export_format="json", codec=None):
+    # The content of the data export, as bytes or as an iterable of byte chunks (see `write_atomic`). For `jsonl`, `ref_index` can also be an iterable of (label, label data) pairs (see `iter_ref_index`).
+    codec = codec or JSON_CODEC
+    assert export_format in [
+        "json",
+        "jsonl",
+    ], f"Unknown data-export-format: {export_format}"
+    if export_format == "jsonl":
+        # One compact object per line, so that consumers can read the file incrementally. The lines are encoded one by one while the file is written.
+        items = ref_index.items() if isinstance(ref_index, dict) else ref_index
+        return (codec.dumps({"label": label, **data}) + b"\n" for label, data in items)
+    return codec.dumps(ref_index, indent=True)
+
+
+def join_exports(writer):
+    # Waits for the background writes of the exported files (see `finalize`), and fails if any of them failed
+    failures = writer.join()
+    for path, error in failures:
+        logger.error(f"Failed to write {path}: {error}")
+    if failures:
+        raise OSError(
+            f"Failed to write the exported files: {', '.join(path for path, _ in failures)}"
+        )
+
+
+def describe_location(elem, max_length=60):
+    # A short human readable description of where an element is: the type and the text of its enclosing block
+    block = elem
+    while not isinstance(block, Block) and not block.parent is None:
+        block = block.parent
+    text = " ".join(to_string(block).split())
+    if len(text) > max_length:
+        text = text[:max_length] + "..."
+    return f"{type(block).__name__} '{text}'"
+
+
+def describe_site(elem):
+    # Where a label is defined: the enclosing block and the position of its top-level block in the document
+    top = elem
+    while not top.parent is None and not isinstance(top.parent, Doc):
+        top = top.parent
+    location = describe_location(elem)
+    if top.parent is None:
+        return location
+    return f"{location}, block {position_in_parent(top) + 1}"
+
+
+def register_label(label, num_obj, doc, elem, implicit=False):
+    # `elem` is the element defining the label, its location is only described when a diagnostic needs it. `implicit` labels are generated automatically (by pandoc or by this filter), they are not expected to be referenced
+    site = lambda: describe_site(elem)
+    if not label:
+        doc.diagnostics.record("empty", label, site)
+        return
+    registry = doc.registry
+    previous_site = registry.site(label) if label in registry else None
+    previous = registry.add(label, num_obj, site=site, implicit=implicit)
+    if not previous is None:
+        doc.diagnostics.record(
+            "duplicate", label, lambda: f"{site()} (previously {previous_site})"
+        )
+
+
+def record_unused_labels(doc):
+    refs = doc.global_vars["referenced_labels"]
+    for label in doc.registry:
+        if not label in refs and not label in doc.registry.implicit:
+            doc.diagnostics.record("unused", label, lambda: doc.registry.site(label))
+
+
+# Output formats whose writers drop raw openxml blocks, identifiers of div elements or links respectively. Formats not listed here always get the full pipeline.
+# The sets were obtained by comparing the outputs of every pandoc writer with each stage switched off.
+BBCODE_FORMATS = set(
+    "bbcode bbcode_fluxbb bbcode_hubzilla bbcode_phpbb bbcode_steam bbcode_xenforo".split()
+)
+NO_OPENXML_FORMATS = BBCODE_FORMATS | set(
+    (
+        "ansi asciidoc asciidoc_legacy asciidoctor biblatex bibtex commonmark context csljson djot "
+        "docbook docbook4 docbook5 gfm haddock html html4 html5 icml "
+        "jats jats_archiving jats_articleauthoring jats_publishing jira latex man "
+        "markdown_github markdown_phpextra markdown_strict markua mediawiki ms "
+        "opendocument opml org plain rtf tei texinfo typst vimdoc"
+    ).split()
+)
+NO_DIV_ID_FORMATS = BBCODE_FORMATS | set(
+    (
+        "ansi biblatex bibtex csljson fb2 haddock icml "
+        "markdown_github markdown_strict markua muse plain rtf vimdoc"
+    ).split()
+)
+NO_LINK_FORMATS = set("biblatex bibtex csljson jira man ms plain xwiki".split())
+
+
+def output_plan(output_format, format_aware=True):
+    # Stages of the filter which are useful for the target writer, the numbering itself is the same for all formats
+    fmt = re.split(r"[+-]", output_format or "", maxsplit=1)[0]
+    if not format_aware:
+        fmt = None
+    return {
+        "openxml": not fmt in NO_OPENXML_FORMATS,
+        "wrap_divs": not fmt in NO_DIV_ID_FORMATS,
+        "caption_links": not fmt in NO_LINK_FORMATS,
+    }
+
+
+OFFSET_KEY_PATTERN = re.compile(
+    r"^(figure|table|equation|subfigure|section|appendix|theorem|environment)(?:-(.+))?-offset(?:-(\d+))?$"
+)
+
+
 def prepare(doc):
     # These are global metadata settings which will be used in the whole document (need to be saved in the doc object)
     # Settings used once will not be saved, thus it only appears in the prepare function
@@ -63,6 +213,8 @@ def prepare(doc):
         "multiline_envs": doc.get_metadata(
             "multiline-environments", "cases,align,aligned,gather,gathered,multline,flalign"
         ).split(","),
+        # Must be one of "nested", "flat": one div per label around an equation paragraph, or one div and empty anchor spans
+        "equation_anchor_style": doc.get_metadata("equation-anchor-style", "nested"),
         # Multiple Reference Settings
         "multiple_ref_suppress": doc.get_metadata("multiple-ref-suppress", True),
         "multiple_ref_separator": doc.get_metadata("multiple-ref-separator", ", "),
@@ -77,25 +229,59 @@ def prepare(doc):
         "custom_lof": doc.get_metadata("custom-lof", False),
         "custom_lot": doc.get_metadata("custom-lot", False),
         "list_leader_type": doc.get_metadata("list-leader-type", "middleDot"),
+        "list_chunk_size": int(doc.get_metadata("list-chunk-size", 1)),
         "lof_title": doc.get_metadata("lof-title", "List of Figures"),
         "lot_title": doc.get_metadata("lot-title", "List of Tables"),
         # Appendix Settings
         "apx_names": doc.get_metadata("appendix-names", "Appendix").split("/,"),
         # Miscellaneous
         "data_export_path": doc.get_metadata("data-export-path", None),
+        "data_export_format": doc.get_metadata("data-export-format", "json"),
+        "data_export_presets": doc.get_metadata(
+            "data-export-presets", "src,ref,cref,Cref"
+        ).split(","),
+        "dependency_export": doc.get_metadata("dependency-export", False),
         "auto_labelling": doc.get_metadata("auto-labelling", True),
+        "plan": output_plan(doc.format, doc.get_metadata("format-aware", True)),
+        "diagnostics_export_path": doc.get_metadata("diagnostics-export-path", None),
+        "strict_labels": doc.get_metadata("strict-labels", False),
+        # In index-only mode, the labels are numbered and exported but the document is not modified
+        "index_only": doc.get_metadata("index-only", False),
+        # Passes with nothing to do according to the census of the first walk are skipped
+        "skip_empty_passes": doc.get_metadata("skip-empty-passes", True),
     }
     # Run-time global variables
     doc.global_vars = {
         # Equations with labels will be wrapped with div elements, since pandoc does not support adding identifiers to math blocks directly
-        "paras2wrap": {"paras": [], "labels": []},
+        # Paragraphs are looked up by identity (`positions` maps the id of a paragraph to its position in `paras`), comparing panflute elements is a deep comparison
+        "paras2wrap": {"paras": [], "labels": [], "positions": {}},
         # Tables with labels will be wrapped with div elements, only in case the table is not labelled in the latex source
         "tabs2wrap": [],
+        # Numbers added to captions, with the URLs of the links they will be turned into
+        "captions2link": [],
         # We save the links to replace here to avoid searching them in the finalize function
         "links2replace": [],
         "lof_block": None,
         "lot_block": None,
+        # Label -> number of references, for the diagnostics
+        "referenced_labels": {},
+        # Candidate elements of every kind found by the first walk, whether numbered or not (see `log_census`)
+        "census": {
+            "headers": 0,
+            "display_math": 0,
+            "figures": 0,
+            "subfigures": 0,
+            "tables": 0,
+            "numbered_divs": 0,
+            "reference_links": 0,
+        },
+        "skipped_passes": [],
     }
+    assert doc.settings["equation_anchor_style"] in [
+        "nested",
+        "flat",
+    ], f"Unknown equation-anchor-style: {doc.settings['equation_anchor_style']}"
+
     thm_names = doc.get_metadata("theorem-names", None)
     doc.settings["theorem_names"] = thm_names.split(",") if thm_names else []
     if doc.settings["num_theorem"] and len(doc.settings["theorem_names"]) == 0:
@@ -107,11 +293,25 @@ def prepare(doc):
             "The number-theorems is enabled but no theorem names are provided. The numbering of theorems will be disabled."
         )
         doc.settings["num_theorem"] = False
+    env_names = doc.get_metadata("environment-names", None)
+    doc.settings["environment_names"] = env_names.split(",") if env_names else []
 
     # Prepare the multiline environment filter pattern for fast checking
     doc.global_vars["multiline_filter_pattern"] = re.compile(
         r"\\begin\{(" + "|".join(doc.settings["multiline_envs"]) + ")}"
     )
+    doc.global_vars["multiline_envs_key"] = tuple(doc.settings["multiline_envs"])
+    # Bounds of the parse cost of one multiline math block, larger blocks are numbered as a whole (see `math_parse_cost_exceeded`)
+    doc.global_vars["math_parse_limits"] = (
+        int(doc.get_metadata("equation-parse-max-length", 20000)),
+        int(doc.get_metadata("equation-parse-max-cells", 2000)),
+        int(doc.get_metadata("equation-parse-max-depth", 100)),
+    )
+    doc.global_vars["math_cache_stats"] = {"hits": 0, "misses": 0}
+    # Display math blocks per numbering path, for the metrics
+    doc.global_vars["equation_paths"] = {"multiline": 0, "plain": 0, "fallback": 0}
+    # Phase name -> duration in seconds, for the metrics
+    doc.global_vars["phase_durations"] = {}
 
     max_levels = int(doc.get_metadata("section-max-levels", 10))
     # From here, we start to build the core formater system for numbering
@@ -123,7 +323,7 @@ def prepare(doc):
         "subfig": "subfigure",
         "apx": "appendix",
     }
-    formaters = {"thm": {}}
+    formaters = {}
     pref_space = doc.get_metadata("prefix-space", True)
 
     for item in ["fig", "tab", "eq"]:
@@ -146,7 +346,23 @@ def prepare(doc):
             num_style=doc.get_metadata(f"{aka[item]}-numstyle", "arabic"),
         )
 
-    for thm_type in doc.settings["theorem_names"]:
+    formaters["subfig"] = Formater(
+        fmt_presets={
+            "src": doc.get_metadata("subfigure-src-format", "({this_num})"),
+            "ref": doc.get_metadata("subfigure-ref-format", "{parent_num}({this_num})"),
+            "cref": doc.get_metadata(
+                "subfigure-cref-format", "{prefix}{parent_num}({this_num})"
+            ),
+            "Cref": doc.get_metadata("subfigure-Cref-format", None),
+        },
+        item_type="subfig",
+        prefix=doc.get_metadata("subfigure-prefix", "Figure"),
+        pref_space=pref_space,
+        num_style=doc.get_metadata("subfigure-numstyle", "latin"),
+    )
+
+    # Formaters of section levels and theorems are only built when they are used for the first time, most documents use a few section levels and theorem types
+    def theorem_formater(thm_type):
         fmt_presets = {}
         item_type = f"thm-{thm_type}"
         for preset, default in [
@@ -157,7 +373,7 @@ def prepare(doc):
         ]:
             fmt = doc.get_metadata(f"theorem-{thm_type}-{preset}-format", default)
             fmt_presets[preset] = fmt
-        formaters["thm"][thm_type] = Formater(
+        return Formater(
             fmt_presets=fmt_presets,
             item_type=item_type,
             prefix=doc.get_metadata(
@@ -167,65 +383,98 @@ def prepare(doc):
             num_style=doc.get_metadata(f"theorem-{thm_type}-numstyle", "arabic"),
         )
 
-    formaters["subfig"] = Formater(
-        fmt_presets={
-            "src": doc.get_metadata("subfigure-src-format", "({this_num})"),
-            "ref": doc.get_metadata("subfigure-ref-format", "{parent_num}({this_num})"),
-            "cref": doc.get_metadata(
-                "subfigure-cref-format", "{prefix}{parent_num}({this_num})"
-            ),
-            "Cref": doc.get_metadata("subfigure-Cref-format", None),
-        },
-        item_type="subfig",
-        prefix=doc.get_metadata("subfigure-prefix", "Figure"),
-        pref_space=pref_space,
-        num_style=doc.get_metadata("subfigure-numstyle", "latin"),
-    )
+    def environment_formater(name):
+        fmt_presets = {}
+        for preset, default in [
+            ["src", None],
+            ["ref", "{num}"],
+            ["cref", "{prefix}{num}"],
+            ["Cref", None],
+        ]:
+            fmt = doc.get_metadata(f"environment-{name}-{preset}-format", default)
+            fmt_presets[preset] = fmt
+        return Formater(
+            fmt_presets=fmt_presets,
+            item_type=name,
+            prefix=doc.get_metadata(f"environment-{name}-prefix", name.capitalize()),
+            pref_space=pref_space,
+            num_style=doc.get_metadata(f"environment-{name}-numstyle", "arabic"),
+        )
 
-    formaters["sec"] = []
-    formaters["apx"] = []
-
-    for item in ["apx", "sec"]:
-        for i in range(1, max_levels + 1):
-            fmt_presets = {}
-            for preset, default in [
-                ["src", None],
-                ["ref", "{num}"],
-                ["cref", "{prefix}{num}"],
-                ["Cref", None],
-            ]:
-                fmt = doc.get_metadata(f"{aka[item]}-{preset}-format-{i}", default)
-                fmt_presets[preset] = fmt
-            if item == "apx" and i == 1:
-                default_numstyle = "Latin"
-            else:
-                default_numstyle = "arabic"
-            i_th_formater = Formater(
-                fmt_presets=fmt_presets,
-                item_type=item,
-                prefix=doc.get_metadata(f"{aka[item]}-prefix", aka[item].capitalize()),
-                pref_space=pref_space,
-                num_style=doc.get_metadata(
-                    f"{aka[item]}-numstyle-{i}", default_numstyle
-                ),
-            )
-            formaters[item].append(i_th_formater)
+    def section_formater(item, level):
+        fmt_presets = {}
+        for preset, default in [
+            ["src", None],
+            ["ref", "{num}"],
+            ["cref", "{prefix}{num}"],
+            ["Cref", None],
+        ]:
+            fmt = doc.get_metadata(f"{aka[item]}-{preset}-format-{level}", default)
+            fmt_presets[preset] = fmt
+        if item == "apx" and level == 1:
+            default_numstyle = "Latin"
+        else:
+            default_numstyle = "arabic"
+        return Formater(
+            fmt_presets=fmt_presets,
+            item_type=item,
+            prefix=doc.get_metadata(f"{aka[item]}-prefix", aka[item].capitalize()),
+            pref_space=pref_space,
+            num_style=doc.get_metadata(
+                f"{aka[item]}-numstyle-{level}", default_numstyle
+            ),
+        )
 
-    # Offsets
+    formaters["thm"] = LazyFormaters(theorem_formater)
+    formaters["env"] = LazyFormaters(environment_formater)
+    # Indexed by the level minus one
+    formaters["sec"] = LazyFormaters(lambda idx: section_formater("sec", idx + 1))
+    formaters["apx"] = LazyFormaters(lambda idx: section_formater("apx", idx + 1))
+
+    items_of_names = {name: item for item, name in aka.items()}
+    # Custom environments: name -> counter resetting it (see `NumberingState`)
+    environments = {}
+    for name in doc.settings["environment_names"]:
+        assert not name in aka and not name.startswith(
+            "thm-"
+        ), f"Invalid environment name: {name}, it is already an item type"
+        reset_by = doc.get_metadata(f"environment-{name}-reset-by", "section")
+        if reset_by == "none":
+            reset_by = None
+        elif reset_by.startswith("theorem-"):
+            reset_by = "thm-" + reset_by[len("theorem-") :]
+        elif reset_by != "section":
+            reset_by = items_of_names.get(reset_by, reset_by)
+        environments[name] = reset_by
+
+    # Offsets: only the offset metadata actually present are read, instead of looking up every level and every theorem type
     offsets = {}
-    for item in ["fig", "tab", "eq", "subfig"]:
-        offset = doc.get_metadata(f"{aka[item]}-offset", 0)
-        if offset != 0:
-            offsets[item] = offset
-    for item in ["sec", "apx"]:
-        for i in range(1, max_levels + 1):
-            offset = doc.get_metadata(f"{aka[item]}-offset-{i}", 0)
-            if offset != 0:
-                offsets[f"{item}_{i}"] = offset
-    for thm_type in doc.settings["theorem_names"]:
-        offset = doc.get_metadata(f"theorem-{thm_type}-offset", 0)
+    for key in doc.metadata.content.keys():
+        match = OFFSET_KEY_PATTERN.match(key)
+        if match is None:
+            continue
+        name, thm_type, level = match.groups()
+        if not name in ["theorem", "environment"] and not thm_type is None:
+            continue
+        if name == "theorem":
+            if not thm_type in doc.settings["theorem_names"]:
+                continue
+            offset_key = f"thm-{thm_type}"
+        elif name == "environment":
+            if not thm_type in environments:
+                continue
+            offset_key = thm_type
+        elif name in ["section", "appendix"]:
+            if level is None or not 1 <= int(level) <= max_levels:
+                continue
+            offset_key = f"{items_of_names[name]}-{level}"
+        elif level is None:
+            offset_key = items_of_names[name]
+        else:
+            continue
+        offset = doc.get_metadata(key, 0)
         if offset != 0:
-            offsets[f"thm-{thm_type}"] = offset
+            offsets[offset_key] = offset
 
     # Initialize a numbering state object
     doc.num_state = NumberingState(
@@ -233,90 +482,433 @@ def prepare(doc):
         max_levels=max_levels,
         formaters=formaters,
         offsets=offsets,
+        theorem_names=doc.settings["theorem_names"],
+        environments=environments,
     )
+    # Class of a numbered div (theorems and custom environments) -> (counter, prefix of the automatic labels)
+    doc.settings["div_items"] = {name: (name, name) for name in environments}
+    if doc.settings["num_theorem"]:
+        doc.settings["div_items"].update(
+            {
+                name: (f"thm-{name}", f"thm_{name}")
+                for name in doc.settings["theorem_names"]
+            }
+        )
 
-    doc.ref_dict = {}
+    doc.registry = LabelRegistry()
+    doc.diagnostics = Diagnostics(strict=doc.settings["strict_labels"])
 
 
-def finalize(doc):
-    # Add labels for equations by wrapping them with div elements, since pandoc does not support adding identifiers to math blocks directly
-    paras2wrap = doc.global_vars["paras2wrap"]
-    paras, labels_list = paras2wrap["paras"], paras2wrap["labels"]
-    assert len(paras) == len(labels_list)
-    for para, labels in zip(paras, labels_list):
-        if labels:
-            try:
-                parent = para.parent
-                idx = parent.content.index(para)
-                del parent.content[idx]
-                div = Div(para, identifier=labels[0])
-                for label in labels[1:]:
-                    div = Div(div, identifier=label)
-                parent.content.insert(idx, div)
-            except Exception as e:
-                logger.warning(
-                    f"Failed to add identifier to paragraph because of {e}. Pleas check: \n The paragraph: {para}. Parent of the paragraph: {parent}"
+def finalize(doc, results=None, artifact=None, with_ref_index=True, writer=None):
+    # The references are replaced, which is the last format-independent change of the document. The format-independent results are then collected as plain data (see `summarize`) and saved with the document in the numbering artifact, if any, before `finish` runs the format-specific steps and the exports.
+    durations = doc.global_vars["phase_durations"]
+    index_only = doc.settings["index_only"]
+    rewrite = not index_only and (
+        not doc.settings["skip_empty_passes"] or rewrite_pending(doc)
+    )
+    if rewrite:
+        start = time.perf_counter()
+        replace_links(doc)
+        durations["rewrite"] = time.perf_counter() - start
+    elif not index_only:
+        doc.global_vars["skipped_passes"].append("rewrite")
+
+    # Every preset of every label is formatted for the label data, which is only snapshotted when it is read as a whole: by the JSON data export, by the dependency index, by the numbering artifact, or by in-process callers asking for it in `results`. The JSON Lines export renders the labels one by one while it is written instead (see `finish`).
+    start = time.perf_counter()
+    settings = doc.settings
+    summary = summarize(
+        doc,
+        with_ref_index=bool(
+            (
+                settings["data_export_path"]
+                and (
+                    settings["data_export_format"] != "jsonl"
+                    or settings["dependency_export"]
                 )
+            )
+            or not artifact is None
+            or (with_ref_index and not results is None)
+        ),
+    )
+    durations["export"] = time.perf_counter() - start
+
+    writer = ExportWriter() if writer is None else writer
+    if not artifact is None and not index_only:
+        start = time.perf_counter()
+        # The document is encoded now, before the format-specific steps change it, the header is encoded in the background
+        header = {"steps": format_steps(doc), "summary": summary}
+        ast_json = serialize(doc)
+        codec = JSON_CODEC
+        writer.submit(artifact.path, lambda: artifact.encode(header, ast_json, codec))
+        durations["artifact"] = time.perf_counter() - start
+        logger.info(f"Saving the numbering artifact: {artifact.path}")
+    finish(doc, summary, results, writer, rewrite)
+
+
+def summarize(doc, with_ref_index=True):
+    # The format-independent results of the numbering as plain data: everything the format-specific steps, the exports and the reports need besides the document itself
+    record_unused_labels(doc)
+    settings = doc.settings
+    registry = doc.registry
+    referenced_labels = doc.global_vars["referenced_labels"]
+    resolved = sum(
+        count for label, count in referenced_labels.items() if label in registry
+    )
+    return {
+        "ref_index": (
+            build_ref_index(registry, settings["data_export_presets"])
+            if with_ref_index
+            else None
+        ),
+        "referenced_labels": referenced_labels,
+        # Items of the lists of figures and tables
+        "lists": {
+            "fig": extract_captions(registry, "fig") if settings["custom_lof"] else [],
+            "tab": extract_captions(registry, "tab") if settings["custom_lot"] else [],
+        },
+        "diagnostics": doc.diagnostics.to_dict(),
+        "counts": {
+            "labels": {
+                item_type: len(labels) for item_type, labels in registry.by_type.items()
+            },
+            "references": {
+                "resolved": resolved,
+                "missing": sum(referenced_labels.values()) - resolved,
+            },
+            "equations": dict(doc.global_vars["equation_paths"]),
+            "census": dict(doc.global_vars["census"]),
+        },
+    }
 
-    # Add labels for tables by wrapping them with div elements. This is necessary because if a table is not labelled in the latex source, pandoc will not generate a div element for it.
-    for tab, label in doc.global_vars["tabs2wrap"]:
-        if label:
-            parent = tab.parent
-            idx = parent.content.index(tab)
-            del parent.content[idx]
-            div = Div(tab, identifier=label)
-            parent.content.insert(idx, div)
 
+def finish(doc, summary, results=None, writer=None, rewrite=True):
+    # The format-specific steps, the exports and the reports, from the results of `summarize`, of this run or of a numbering artifact
+    durations = doc.global_vars["phase_durations"]
+    if rewrite:
+        start = time.perf_counter()
+        apply_format_steps(doc, summary["lists"])
+        durations["rewrite"] = durations.get("rewrite", 0.0) + (
+            time.perf_counter() - start
+        )
+    log_census(doc)
+
+    # The exported data is encoded and written in the background while the caller serializes the output (see `writer.py`). It is either the snapshot of `summarize` (all the presets are formatted), or, for the JSON Lines export without a snapshot, rendered label by label from the registry, which is not changed after the numbering.
+    start = time.perf_counter()
+    writer = ExportWriter() if writer is None else writer
+    codec = JSON_CODEC
+    ref_index = summary["ref_index"]
+    if doc.settings["data_export_path"]:
+        export_format = doc.settings["data_export_format"]
+        if ref_index is None:
+            registry = doc.registry
+            presets = doc.settings["data_export_presets"]
+            encode = lambda: encode_ref_index(
+                iter_ref_index(registry, presets), export_format, codec
+            )
+            label_count = len(registry)
+        else:
+            encode = lambda: encode_ref_index(ref_index, export_format, codec)
+            label_count = len(ref_index)
+        writer.submit(
+            doc.settings["data_export_path"],
+            encode,
+            use_process=label_count >= PROCESS_MIN_LABELS,
+        )
+        # The labels defined and referenced by the document, next to the data export
+        if doc.settings["dependency_export"]:
+            dependency_record = build_dependency_record(
+                ref_index,
+                summary["referenced_labels"],
+                doc.settings["data_export_presets"],
+            )
+            writer.submit(
+                dependency_path(doc.settings["data_export_path"]),
+                lambda: codec.dumps(dependency_record, indent=True),
+            )
+    durations["export"] = durations.get("export", 0.0) + (time.perf_counter() - start)
+
+    math_cache_stats = doc.global_vars["math_cache_stats"]
+    parsed = math_cache_stats["hits"] + math_cache_stats["misses"]
+    if parsed:
+        logger.info(
+            f"Multiline equation parse cache: {math_cache_stats['hits']} hits, {math_cache_stats['misses']} misses ({math_cache_stats['hits'] / parsed:.0%} hit rate)"
+        )
+
+    # Report all the label problems at once
+    doc.diagnostics.report()
+    if doc.settings["diagnostics_export_path"]:
+        diagnostics_data = summary["diagnostics"]
+        writer.submit(
+            doc.settings["diagnostics_export_path"],
+            lambda: codec.dumps(diagnostics_data, indent=True),
+        )
+
+    # Results requested by in-process callers (see `number_document`), collected before the run state is dropped. The callers must join `results["writer"]` once the output is serialized.
+    if not results is None:
+        results["ref_index"] = ref_index
+        results["writer"] = writer
+        results["export_paths"] = [
+            path
+            for path in [
+                doc.settings["data_export_path"],
+                doc.settings["diagnostics_export_path"],
+            ]
+            if path
+        ]
+        if doc.settings["data_export_path"] and doc.settings["dependency_export"]:
+            results["export_paths"].append(
+                dependency_path(doc.settings["data_export_path"])
+            )
+        results["metrics"] = collect_metrics(doc, summary)
+        results["diagnostics"] = summary["diagnostics"]
+
+    # Clean up the global variables
+    del doc.settings
+    del doc.global_vars
+    del doc.num_state
+    del doc.registry
+    del doc.diagnostics
+
+    if results is None:
+        join_exports(writer)
+    logger.info("Finished pandoc-tex-numbering")
+
+
+def replay_numbering(doc, header, results=None, writer=None):
+    # Runs the format-specific steps on the document saved in a numbering artifact (see `artifact.py`), the numbering itself was done by the run which saved it
+    start = time.perf_counter()
+    prepare(doc)
+    durations = doc.global_vars["phase_durations"]
+    durations["prepare"] = time.perf_counter() - start
+    steps, summary = header["steps"], header["summary"]
+    global_vars = doc.global_vars
+    paras2wrap = global_vars["paras2wrap"]
+    for path, labels in steps["paras2wrap"]:
+        paras2wrap["paras"].append(resolve_path(doc, path))
+        paras2wrap["labels"].append(labels)
+    global_vars["tabs2wrap"] = [
+        [resolve_path(doc, path), label] for path, label in steps["tabs2wrap"]
+    ]
+    global_vars["captions2link"] = [
+        (resolve_path(doc, path), url) for path, url in steps["captions2link"]
+    ]
+    global_vars["census"] = summary["counts"]["census"]
+    doc.diagnostics = Diagnostics.from_dict(
+        summary["diagnostics"], strict=doc.settings["strict_labels"]
+    )
+    rewrite = not doc.settings["skip_empty_passes"] or format_steps_pending(doc)
+    if not rewrite:
+        global_vars["skipped_passes"].append("rewrite")
+    finish(doc, summary, results, writer, rewrite)
+    return doc
+
+
+def format_steps_pending(doc):
+    # Whether the format-specific steps have anything to change in the document for the output format
+    plan = doc.settings["plan"]
+    global_vars = doc.global_vars
+    return bool(
+        (
+            plan["wrap_divs"]
+            and (global_vars["paras2wrap"]["paras"] or global_vars["tabs2wrap"])
+        )
+        or (plan["caption_links"] and global_vars["captions2link"])
+        or (
+            (doc.settings["custom_lof"] or doc.settings["custom_lot"])
+            and plan["openxml"]
+        )
+    )
+
+
+def rewrite_pending(doc):
+    # Whether the final stage has anything to change in the document
+    return bool(doc.global_vars["links2replace"] or format_steps_pending(doc))
+
+
+def format_steps(doc):
+    # The elements changed by the format-specific steps, by their paths in the document, for the numbering artifact
+    positions = {}
+    paras2wrap = doc.global_vars["paras2wrap"]
+    return {
+        "paras2wrap": [
+            [element_path(para, positions), labels]
+            for para, labels in zip(paras2wrap["paras"], paras2wrap["labels"])
+        ],
+        "tabs2wrap": [
+            [element_path(tab, positions), label]
+            for tab, label in doc.global_vars["tabs2wrap"]
+        ],
+        "captions2link": [
+            [element_path(number, positions), url]
+            for number, url in doc.global_vars["captions2link"]
+        ],
+    }
+
+
+def log_census(doc):
+    census = doc.global_vars["census"]
+    skipped = doc.global_vars["skipped_passes"]
+    logger.info(
+        f"Census: {', '.join(f'{count} {kind}' for kind, count in census.items())}; skipped passes: {', '.join(skipped) if skipped else 'none'}"
+    )
+
+
+def collect_metrics(doc, summary):
+    # Counters of the run as plain data, written by the metrics sink of the command line filter (see `metrics.py`)
+    math_cache_stats = doc.global_vars["math_cache_stats"]
+    counts = summary["counts"]
+    return {
+        "format": doc.format,
+        "labels": dict(counts["labels"]),
+        "references": dict(counts["references"]),
+        "equations": dict(counts["equations"]),
+        "math_parses": {
+            "hit": math_cache_stats["hits"],
+            "miss": math_cache_stats["misses"],
+        },
+        "durations": dict(doc.global_vars["phase_durations"]),
+        "census": dict(counts["census"]),
+        "skipped_passes": list(doc.global_vars["skipped_passes"]),
+    }
+
+
+def position_in_parent(elem):
+    # `list.index` would compare the elements deeply, we look for the element itself instead
+    for idx, item in enumerate(elem.parent.content.list):
+        if item is elem:
+            return idx
+    raise ValueError(f"{elem} is not in its parent")
+
+
+def replace_links(doc):
     for link, items in doc.global_vars["links2replace"]:
         parent = link.parent
-        idx = parent.content.index(link)
+        idx = position_in_parent(link)
         del parent.content[idx]
         for item in items[::-1]:
             parent.content.insert(idx, item)
 
-    if doc.settings["custom_lot"]:
+
+def apply_format_steps(doc, lists):
+    # The changes of the document whose results are dropped by some writers (see `output_plan`), `lists` are the items of the lists of figures and tables
+    plan = doc.settings["plan"]
+    if plan["wrap_divs"]:
+        wrap_elements(doc)
+
+    # Numbers in captions become links to their items
+    if plan["caption_links"]:
+        for number, url in doc.global_vars["captions2link"]:
+            parent = number.parent
+            idx = position_in_parent(number)
+            del parent.content[idx]
+            parent.content.insert(idx, Link(number, url=url))
+
+    if doc.settings["custom_lot"] and plan["openxml"]:
         doc.content.insert(0, RawBlock("\\listoftables", format="latex"))
         doc.global_vars["lot_block"] = doc.content[0]
-        table_items = extract_captions_from_refdict(doc.ref_dict, "tab", doc)
         add_docx_list(
             doc.global_vars["lot_block"],
-            table_items,
+            lists["tab"],
             doc.settings["lot_title"],
             leader_type=doc.settings["list_leader_type"],
+            chunk_size=doc.settings["list_chunk_size"],
         )
 
-    if doc.settings["custom_lof"]:
+    if doc.settings["custom_lof"] and plan["openxml"]:
         doc.content.insert(0, RawBlock("\\listoffigures", format="latex"))
         doc.global_vars["lof_block"] = doc.content[0]
-        figure_items = extract_captions_from_refdict(doc.ref_dict, "fig", doc)
         add_docx_list(
             doc.global_vars["lof_block"],
-            figure_items,
+            lists["fig"],
             doc.settings["lof_title"],
             leader_type=doc.settings["list_leader_type"],
+            chunk_size=doc.settings["list_chunk_size"],
         )
 
-    # Export the reference dictionary to a json file
-    if doc.settings["data_export_path"]:
-        with open(doc.settings["data_export_path"], "w") as f:
-            ref_dict_data = {
-                label: num_obj.to_dict() for label, num_obj in doc.ref_dict.items()
-            }
-            json.dump(ref_dict_data, f, indent=2, ensure_ascii=False)
 
-    # Clean up the global variables
-    del doc.settings
-    del doc.global_vars
-    del doc.num_state
-    del doc.ref_dict
+def wrap_elements(doc):
+    # Add labels for equations by wrapping them with div elements, since pandoc does not support adding identifiers to math blocks directly
+    paras2wrap = doc.global_vars["paras2wrap"]
+    paras, labels_list = paras2wrap["paras"], paras2wrap["labels"]
+    assert len(paras) == len(labels_list)
+    flat_anchors = doc.settings["equation_anchor_style"] == "flat"
+    for para, labels in zip(paras, labels_list):
+        if labels:
+            try:
+                parent = para.parent
+                idx = position_in_parent(para)
+                del parent.content[idx]
+                if flat_anchors:
+                    # One div for the first label, and empty anchor spans at the beginning of the paragraph for the other labels
+                    for label in labels[:0:-1]:
+                        para.content.insert(0, Span(identifier=label))
+                    div = Div(para, identifier=labels[0])
+                else:
+                    # One nested div per label
+                    div = Div(para, identifier=labels[0])
+                    for label in labels[1:]:
+                        div = Div(div, identifier=label)
+                parent.content.insert(idx, div)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to add identifier to paragraph because of {e}. Pleas check: \n The paragraph: {para}. Parent of the paragraph: {parent}"
+                )
 
-    logger.info("Finished pandoc-tex-numbering")
+    # Add labels for tables by wrapping them with div elements. This is necessary because if a table is not labelled in the latex source, pandoc will not generate a div element for it.
+    for tab, label in doc.global_vars["tabs2wrap"]:
+        if label:
+            parent = tab.parent
+            idx = position_in_parent(tab)
+            del parent.content[idx]
+            div = Div(tab, identifier=label)
+            parent.content.insert(idx, div)
 
 
-def _parse_multiline_environment(root_node, doc):
-    labels = {}
-    environment_body = ""
-    # Multiple equations
+BRACE_PATTERN = re.compile(r"(?<!\\)[{}]")
+
+
+def math_parse_cost_exceeded(math_str: str, limits):
+    # The parse time of LatexWalker grows with the size of the block, and deeply nested groups exhaust the recursion limit. Returns the reason if the block exceeds one of the limits, otherwise None.
+    max_length, max_cells, max_depth = limits
+    if len(math_str) > max_length:
+        return f"{len(math_str)} characters > equation-parse-max-length {max_length}"
+    cells = math_str.count("&")
+    if cells > max_cells:
+        return f"{cells} '&' cells > equation-parse-max-cells {max_cells}"
+    depth = 0
+    for match in BRACE_PATTERN.finditer(math_str):
+        if match.group() == "{":
+            depth += 1
+            if depth > max_depth:
+                return f"brace nesting > equation-parse-max-depth {max_depth}"
+        else:
+            depth -= 1
+    return None
+
+
+def parse_math_structure(math_str: str, multiline_envs, limits=None):
+    # The structure of a multiline math block, independent of the numbering state: the environment name and the rows of the environment as (verbatim latex, numbered, label) tuples.
+    # None if the block is not a single multiline environment, i.e. it is numbered as a whole.
+    # A string (the reason) if the block is too costly to parse, it is then numbered as a whole as well.
+    if not limits is None:
+        reason = math_parse_cost_exceeded(math_str, limits)
+        if not reason is None:
+            return reason
+    walker = LatexWalker(math_str)
+    try:
+        nodelist, _, _ = walker.get_latex_nodes(pos=0)
+    except RecursionError:
+        return "brace nesting too deep for the latex parser"
+    if len(nodelist) != 1:
+        return None
+    root_node = nodelist[0]
+    if not (
+        isinstance(root_node, LatexEnvironmentNode)
+        and root_node.environmentname in multiline_envs
+    ):
+        return None
+    rows = []
+    pieces = []
     label_of_this_line = None
     is_label_this_line = True
     for node in root_node.nodelist:
@@ -330,30 +922,39 @@ def _parse_multiline_environment(root_node, doc):
             if node.macroname == "nonumber":
                 is_label_this_line = False
             if node.macroname == "\\":
-                if is_label_this_line:
-                    doc.num_state.next_eq()
-                    num_obj = doc.num_state.current_eq()
-                    environment_body += f"{{{num_obj.src}}}"
-                    if label_of_this_line:
-                        labels[label_of_this_line] = num_obj
+                rows.append(("".join(pieces), is_label_this_line, label_of_this_line))
+                pieces = []
                 label_of_this_line = None
                 is_label_this_line = True
-        environment_body += node.latex_verbatim()
-
-    if is_label_this_line:
-        doc.num_state.next_eq()
-        num_obj = doc.num_state.current_eq()
-        environment_body += f"{{{num_obj.src}}}"
-        if label_of_this_line:
-            labels[label_of_this_line] = num_obj
-    modified_math_str = f"\\begin{{{root_node.environmentname}}}{environment_body}\\end{{{root_node.environmentname}}}"
+        pieces.append(node.latex_verbatim())
+    rows.append(("".join(pieces), is_label_this_line, label_of_this_line))
+    return root_node.environmentname, tuple(rows)
+
+
+def _number_math_structure(structure, doc):
+    # Numbers are assigned per occurrence, the (possibly cached) structure itself is never modified
+    environment_name, rows = structure
+    labels = {}
+    body = []
+    for verbatim, numbered, label in rows:
+        body.append(verbatim)
+        if numbered:
+            doc.num_state.next("eq")
+            num_obj = doc.num_state.current("eq")
+            body.append(f"{{{num_obj.src}}}")
+            if label:
+                labels[label] = num_obj
+    environment_body = "".join(body)
+    modified_math_str = (
+        f"\\begin{{{environment_name}}}{environment_body}\\end{{{environment_name}}}"
+    )
     return modified_math_str, labels
 
 
 def _parse_plain_math(math_str: str, doc):
     labels = {}
-    doc.num_state.next_eq()
-    num_obj = doc.num_state.current_eq()
+    doc.num_state.next("eq")
+    num_obj = doc.num_state.current("eq")
     modified_math_str = f"{math_str}{{{num_obj.src}}}"
     label_strings = re.findall(r"\\label\{(.*?)\}", math_str)
     if len(label_strings) >= 2:
@@ -363,7 +964,7 @@ def _parse_plain_math(math_str: str, doc):
     return modified_math_str, labels
 
 
-def parse_latex_math(math_str: str, doc):
+def parse_latex_math(math_str: str, doc, location=None):
     math_str = math_str.strip()
     # Add numbering to every line of the math block when and only when:
     # 1. The top level environment is a multiline environment
@@ -372,24 +973,35 @@ def parse_latex_math(math_str: str, doc):
 
     # Fast check if it is a multiline environment
     if re.match(doc.global_vars["multiline_filter_pattern"], math_str):
-        walker = LatexWalker(math_str)
-        nodelist, _, _ = walker.get_latex_nodes(pos=0)
-        if len(nodelist) == 1:
-            root_node = nodelist[0]
-            if (
-                isinstance(root_node, LatexEnvironmentNode)
-                and root_node.environmentname in doc.settings["multiline_envs"]
-            ):
-                return _parse_multiline_environment(root_node, doc)
+        multiline_envs = doc.global_vars["multiline_envs_key"]
+        limits = doc.global_vars["math_parse_limits"]
+        # Identical math blocks (e.g. boilerplate environments) are only parsed once, the parse results are cached by content
+        structure, hit = MATH_STRUCTURE_CACHE.get_or_compute(
+            (math_str, multiline_envs, limits),
+            lambda: parse_math_structure(math_str, multiline_envs, limits),
+        )
+        doc.global_vars["math_cache_stats"]["hits" if hit else "misses"] += 1
+        if isinstance(structure, str):
+            doc.global_vars["equation_paths"]["fallback"] += 1
+            modified_math_str, labels = _parse_plain_math(math_str, doc)
+            doc.diagnostics.record(
+                "fallback",
+                ",".join(labels),
+                lambda: (
+                    f"{location()} ({structure})" if callable(location) else structure
+                ),
+            )
+            return modified_math_str, labels
+        if not structure is None:
+            doc.global_vars["equation_paths"]["multiline"] += 1
+            return _number_math_structure(structure, doc)
     # Otherwise, add numbering to the whole math block
+    doc.global_vars["equation_paths"]["plain"] += 1
     return _parse_plain_math(math_str, doc)
 
 
-def add_label_to_caption(num_obj, label: str, elem):
-    url = f"#{label}" if label else ""
-    label_items = [
-        Link(Str(num_obj.src), url=url),
-    ]
+def add_label_to_caption(num_obj, label: str, elem, captions2link):
+    label_items = [Str(num_obj.src)]
     has_caption = True
     if not elem.caption:
         elem.caption = Caption(Plain(Str("")), short_caption=ListContainer([Str("")]))
@@ -402,6 +1014,10 @@ def add_label_to_caption(num_obj, label: str, elem):
         label_items.extend([Str(":"), Space()])
     for item in label_items[::-1]:
         elem.caption.content[0].content.insert(0, item)
+    # The number is turned into a link to the item by `apply_format_steps`, for the formats which keep links. Panflute sets the parent of an element when it is read from its container, not when it is inserted.
+    captions2link.append(
+        (elem.caption.content[0].content[0], f"#{label}" if label else "")
+    )
 
 
 def find_labels_header(elem, doc):
@@ -421,23 +1037,28 @@ def find_labels_header(elem, doc):
     # Check for identifier
     if elem.identifier:
         label = elem.identifier
-        doc.ref_dict[label] = num_obj
+        register_label(label, num_obj, doc, elem, implicit=True)
 
     for child in elem.content:
         if isinstance(child, Span) and "label" in child.attributes:
             label = child.attributes["label"]
-            doc.ref_dict[label] = num_obj
-    if doc.settings["num_sec"]:
+            register_label(label, num_obj, doc, elem)
+    if doc.settings["num_sec"] and not doc.settings["index_only"]:
         elem.content.insert(0, Space())
         elem.content.insert(0, Str(num_obj.src))
 
 
 def find_labels_math(elem, doc):
     math_str = elem.text
-    modified_math_str, labels = parse_latex_math(math_str, doc)
-    elem.text = modified_math_str
+    modified_math_str, labels = parse_latex_math(
+        math_str, doc, location=lambda: describe_location(elem)
+    )
     for label, num_obj in labels.items():
-        doc.ref_dict[label] = num_obj
+        register_label(label, num_obj, doc, elem)
+    if doc.settings["index_only"]:
+        return
+    elem.text = modified_math_str
+    # The paragraph is recorded for every output format, it is wrapped only for the formats which keep the identifiers of divs (see `apply_format_steps`)
     if labels:
         this_elem = elem
         while not isinstance(this_elem, Para):
@@ -446,100 +1067,139 @@ def find_labels_math(elem, doc):
                 logger.warning(f"Unexpected parent of math block: {this_elem}")
                 break
         else:
-            if not this_elem in doc.global_vars["paras2wrap"]["paras"]:
-                doc.global_vars["paras2wrap"]["paras"].append(this_elem)
-                doc.global_vars["paras2wrap"]["labels"].append(list(labels.keys()))
+            paras2wrap = doc.global_vars["paras2wrap"]
+            idx = paras2wrap["positions"].get(id(this_elem))
+            if idx is None:
+                paras2wrap["positions"][id(this_elem)] = len(paras2wrap["paras"])
+                paras2wrap["paras"].append(this_elem)
+                paras2wrap["labels"].append(list(labels.keys()))
             else:
-                idx = doc.global_vars["paras2wrap"]["paras"].index(this_elem)
-                doc.global_vars["paras2wrap"]["labels"][idx].extend(labels.keys())
+                paras2wrap["labels"][idx].extend(labels.keys())
 
 
 def find_labels_table(elem, doc):
-    doc.num_state.next_tab()
+    doc.num_state.next("tab")
     # The label of a table will be added to a div element wrapping the table, if any. And if there is not, the div element will be not created.
-    num_obj = doc.num_state.current_tab()
+    num_obj = doc.num_state.current("tab")
+    rewrite = not doc.settings["index_only"]
+    is_auto_label = False
     if isinstance(elem.parent, Div):
         label = elem.parent.identifier
         if not label and doc.settings["auto_labelling"]:
             label = f"tab:{num_obj.ref}"
-            elem.parent.identifier = label
+            is_auto_label = True
+            if rewrite:
+                elem.parent.identifier = label
     else:
         if doc.settings["auto_labelling"]:
             label = f"tab:{num_obj.ref}"
-            doc.global_vars["tabs2wrap"].append([elem, label])
+            is_auto_label = True
+            if rewrite:
+                doc.global_vars["tabs2wrap"].append([elem, label])
         else:
             label = ""
 
     num_obj.caption = to_string(elem.caption)
-    add_label_to_caption(num_obj, label, elem)
+    if rewrite:
+        add_label_to_caption(num_obj, label, elem, doc.global_vars["captions2link"])
     if label:
-        doc.ref_dict[label] = num_obj
+        register_label(label, num_obj, doc, elem, implicit=is_auto_label)
 
 
 def find_labels_figure(elem, doc):
-    # We will walk the subfigures in a Figure element manually, therefore we directly skip the subfigures from global walking
-    if isinstance(elem.parent, Figure):
-        return
+    # The walker does not descend into figures (see `run_numbering`). The content and the caption of the figure are walked here first, in the order of the walker (children before their parents), then the figure and its subfigures are numbered top-down, so that every subfigure is visited exactly once
+    elem.content.walk(action_find_labels_in_figure, doc)
+    elem.caption.walk(action_find_labels_in_figure, doc)
 
-    doc.num_state.next_fig()
+    doc.num_state.next("fig")
     _find_labels_figure(elem, doc, subfigure=False)
 
     for child in elem.content:
         if isinstance(child, Figure):
-            doc.num_state.next_subfig()
+            doc.global_vars["census"]["subfigures"] += 1
+            doc.num_state.next("subfig")
             _find_labels_figure(child, doc, subfigure=True)
 
 
 def _find_labels_figure(elem, doc, subfigure=False):
     label = elem.identifier
-    num_obj = doc.num_state.current_fig(subfig=subfigure)
+    num_obj = doc.num_state.current("subfig" if subfigure else "fig")
+    rewrite = not doc.settings["index_only"]
+    is_auto_label = False
     if not label and doc.settings["auto_labelling"]:
         label = f"fig:{num_obj.ref}"
-        elem.identifier = label
+        is_auto_label = True
+        if rewrite:
+            elem.identifier = label
 
     num_obj.caption = to_string(elem.caption)
     num_obj.short_caption = to_string(elem.caption.short_caption)
-    add_label_to_caption(num_obj, label, elem)
+    if rewrite:
+        add_label_to_caption(num_obj, label, elem, doc.global_vars["captions2link"])
     if label:
-        doc.ref_dict[label] = num_obj
+        register_label(label, num_obj, doc, elem, implicit=is_auto_label)
 
 
-def find_labels_theorem(elem, doc):
-    thm_type = [cls for cls in elem.classes if cls in doc.settings["theorem_names"]][0]
-    doc.num_state.next_thm(thm_type)
+def find_labels_div(elem, doc, item, label_prefix):
+    # Theorems and custom environments, `item` is the counter of the class of the div
+    doc.num_state.next(item)
     label = elem.identifier
-    num_obj = doc.num_state.current_thm(thm_type)
+    if not label and elem.content and isinstance(elem.content[0], (Para, Plain)):
+        # Pandoc keeps the `\label` of an environment it does not know as a span at the beginning of the div
+        for child in elem.content[0].content:
+            if isinstance(child, Span) and "label" in child.attributes:
+                label = child.attributes["label"]
+                break
+    num_obj = doc.num_state.current(item)
+    is_auto_label = False
     if not label:
-        elem.identifier = f"thm_{thm_type}:{num_obj.ref}"
-    doc.ref_dict[label] = num_obj
+        label = f"{label_prefix}:{num_obj.ref}"
+        is_auto_label = True
+        if not doc.settings["index_only"]:
+            elem.identifier = label
+    register_label(label, num_obj, doc, elem, implicit=is_auto_label)
 
 
 def action_find_labels(elem, doc):
-    # Find labels in headers, math blocks, figures and tables
+    # Find labels in headers, math blocks, figures and tables, and count the candidate elements in the census
+    if isinstance(elem, Link):
+        if "reference-type" in elem.attributes:
+            doc.global_vars["census"]["reference_links"] += 1
+        return
     if isinstance(elem, Header):
         # We should always find labels in headers since we need the section numbering information
+        doc.global_vars["census"]["headers"] += 1
         find_labels_header(elem, doc)
-    if (
-        isinstance(elem, Math)
-        and elem.format == "DisplayMath"
-        and doc.settings["num_eq"]
-    ):
-        find_labels_math(elem, doc)
-    if isinstance(elem, Figure) and doc.settings["num_fig"]:
-        find_labels_figure(elem, doc)
-    if isinstance(elem, Table) and doc.settings["num_tab"]:
-        find_labels_table(elem, doc)
+    if isinstance(elem, Math) and elem.format == "DisplayMath":
+        doc.global_vars["census"]["display_math"] += 1
+        if doc.settings["num_eq"]:
+            find_labels_math(elem, doc)
+    if isinstance(elem, Figure):
+        doc.global_vars["census"]["figures"] += 1
+        if doc.settings["num_fig"]:
+            find_labels_figure(elem, doc)
+    if isinstance(elem, Table):
+        doc.global_vars["census"]["tables"] += 1
+        if doc.settings["num_tab"]:
+            find_labels_table(elem, doc)
     # if isinstance(elem,RawBlock) and (doc.settings["custom_lof"] or doc.settings["custom_lot"]) and elem.format == "latex":
     #     if "listoffigures" in elem.text:
     #         doc.global_vars["lof_block"] = elem
     #     if "listoftables" in elem.text:
     #         doc.global_vars["lot_block"] = elem
     if isinstance(elem, Div):
-        if (
-            any([cls in doc.settings["theorem_names"] for cls in elem.classes])
-            and doc.settings["num_theorem"]
-        ):
-            find_labels_theorem(elem, doc)
+        div_items = doc.settings["div_items"]
+        for cls in elem.classes:
+            if cls in div_items:
+                doc.global_vars["census"]["numbered_divs"] += 1
+                find_labels_div(elem, doc, *div_items[cls])
+                break
+
+
+def action_find_labels_in_figure(elem, doc):
+    # Figures nested in a figure are either already numbered as subfigures or not numbered at all
+    if not isinstance(elem, Figure):
+        action_find_labels(elem, doc)
 
 
 def _num2link(num_obj, fmt_preset):
@@ -575,13 +1235,13 @@ def labels2refs(labels, ref_type, doc):
         "eqref",
     ], f"Unknown reference-type: {ref_type}"
     num_objs = []
-    for label in list(set(labels)):
-        if label in doc.ref_dict:
-            num_obj = doc.ref_dict[label]
+    # Duplicates are dropped in citation order: items with equal numbers (e.g. in a section and in an appendix) keep the same order in every run, whatever the hash seed
+    for label in dict.fromkeys(labels):
+        # Missing labels are recorded in the diagnostics by `action_replace_refs`
+        if label in doc.registry:
+            num_obj = doc.registry[label]
             num_obj.label = label
             num_objs.append(num_obj)
-        else:
-            logger.warning(f"Reference not found: {label}")
 
     is_suppress = doc.settings["multiple_ref_suppress"]
 
@@ -644,18 +1304,162 @@ def labels2refs(labels, ref_type, doc):
 def action_replace_refs(elem, doc):
     if isinstance(elem, Link) and "reference-type" in elem.attributes:
         labels = elem.attributes["reference"].split(",")
+        referenced_labels = doc.global_vars["referenced_labels"]
+        for label in labels:
+            referenced_labels[label] = referenced_labels.get(label, 0) + 1
+            if not label in doc.registry:
+                doc.diagnostics.record(
+                    "missing", label, lambda: describe_location(elem)
+                )
+        if doc.settings["index_only"]:
+            return
         results = labels2refs(labels, elem.attributes["reference-type"], doc)
         doc.global_vars["links2replace"].append((elem, results))
 
 
+def run_numbering(doc, results=None, artifact=None, with_ref_index=True, writer=None):
+    # All the state of a run is attached to `doc` and dropped in `finalize`, nothing is shared between runs on different documents
+    # `writer` is the `ExportWriter` of the exported files, by default a writer which never forks
+    start = time.perf_counter()
+    prepare(doc)
+    durations = doc.global_vars["phase_durations"]
+    durations["prepare"] = time.perf_counter() - start
+    # Figures are handled top-down by `find_labels_figure`, which walks their content itself. Therefore the walker stops descending at figures, so that every subfigure is visited exactly once.
+    if doc.settings["num_fig"]:
+        stop_if = lambda elem: isinstance(elem, Figure)
+    else:
+        stop_if = None
+    start = time.perf_counter()
+    doc = doc.walk(action_find_labels, doc, stop_if=stop_if)
+    durations["find_labels"] = time.perf_counter() - start
+    # References are only looked for when the first walk saw reference links
+    if (
+        doc.global_vars["census"]["reference_links"]
+        or not doc.settings["skip_empty_passes"]
+    ):
+        start = time.perf_counter()
+        doc = doc.walk(action_replace_refs, doc)
+        durations["replace_refs"] = time.perf_counter() - start
+    else:
+        doc.global_vars["skipped_passes"].append("replace_refs")
+    finalize(doc, results, artifact, with_ref_index, writer)
+    return doc
+
+
+# Metadata which make the filter write files. In-process callers only get these side effects when they pass them explicitly as overrides, never from the metadata of the document itself.
+FILE_EXPORT_METADATA = ["data-export-path", "diagnostics-export-path"]
+
+
+def number_document(ast_json, metadata_overrides=None, output_format="html"):
+    # In-process entry: number a pandoc JSON AST (bytes or str) and return the new JSON AST (bytes) together with the label index.
+    # Every call works on its own `Doc` object, so concurrent calls from several threads do not share any state.
+    if isinstance(ast_json, str):
+        ast_json = ast_json.encode("utf-8")
+    doc = JSON_CODEC.load_doc(ast_json)
+    doc.format = output_format
+    for key in FILE_EXPORT_METADATA:
+        if key in doc.metadata:
+            del doc.metadata[key]
+    for key, value in (metadata_overrides or {}).items():
+        doc.metadata[key] = value
+    index_only = doc.get_metadata("index-only", False)
+
+    results = {}
+    doc = run_numbering(doc, results)
+    output = ast_json if index_only else serialize(doc)
+    join_exports(results["writer"])
+    return output, results["ref_index"]
+
+
+def serialize(doc, codec=None):
+    # The same JSON as `panflute.dump`, as UTF-8 bytes
+    return (codec or JSON_CODEC).dumps(doc)
+
+
 def main(doc=None):
+    setup_log_file()
     logger.info("Starting pandoc-tex-numbering")
-    return run_filters(
-        [action_find_labels, action_replace_refs],
-        doc=doc,
-        prepare=prepare,
-        finalize=finalize,
+    if not doc is None:
+        return run_numbering(doc)
+
+    # The input is read in one bulk read and the output written in one write, the JSON is decoded and encoded in memory by `JSON_CODEC`
+    raw_input = sys.stdin.buffer.read()
+    output_format = sys.argv[1] if len(sys.argv) > 1 else "html"
+    # Metrics are only written when enabled by the environment, see `metrics.py`
+    metrics_sink = MetricsSink.from_env()
+    # Whole runs are cached on disk when enabled, the cache is checked before the document is loaded
+    result_cache = ResultCache.from_env()
+    if not result_cache is None:
+        cache_key = result_cache.key(raw_input, output_format)
+        cached = result_cache.get(cache_key)
+        if not cached is None:
+            output, exports, diagnostics = cached
+            for path, content in exports.items():
+                write_atomic(path, content.encode("utf-8"))
+            logger.info(f"Result cache hit: {cache_key}")
+            # The label problems of the document are reported like on a miss
+            Diagnostics.from_dict(diagnostics).report()
+            if os.environ.get(ARTIFACT_ENV):
+                # The cached output is already formatted for the writer, there is no document before the format-specific steps to save
+                logger.info("The numbering artifact is not saved on a result cache hit")
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+            if not metrics_sink is None:
+                metrics_sink.record({"format": output_format}, cache="hit")
+            return
+
+    # The numbering artifact saved by a run on the same input for another output format, see `artifact.py`
+    artifact = NumberingArtifact.from_env(raw_input)
+    loaded = None if artifact is None else artifact.load()
+    # The garbage collector is paused while the whole document is decoded and encoded, see `codec.py`
+    start = time.perf_counter()
+    with paused_gc():
+        doc = JSON_CODEC.load_doc(raw_input if loaded is None else loaded[1])
+    doc.format = output_format
+    load_duration = time.perf_counter() - start
+    index_only = doc.get_metadata("index-only", False)
+    results = {}
+    # The filter owns its process, large exports may be written by a forked child
+    writer = ExportWriter(allow_processes=True)
+    if loaded is None:
+        # The command line filter only needs the label data for the files it writes
+        doc = run_numbering(doc, results, artifact, with_ref_index=False, writer=writer)
+    else:
+        logger.info(f"Numbering artifact hit: {artifact.path}")
+        doc = replay_numbering(doc, loaded[0], results, writer)
+    start = time.perf_counter()
+    if index_only:
+        # The document is not modified in index-only mode, we pass the input through instead of serializing it again
+        output = raw_input
+    else:
+        with paused_gc():
+            output = serialize(doc)
+    results["metrics"]["durations"].update(
+        load=load_duration, serialize=time.perf_counter() - start
     )
+    sys.stdout.buffer.write(output)
+    sys.stdout.buffer.flush()
+    # The exported files are written in the background since `finalize`
+    start = time.perf_counter()
+    join_exports(results["writer"])
+    results["metrics"]["durations"]["export_wait"] = time.perf_counter() - start
+
+    if not result_cache is None:
+        exports = {}
+        for path in results["export_paths"]:
+            with open(path, "r", encoding="utf-8") as f:
+                exports[path] = f.read()
+        result_cache.put(cache_key, output, exports, results["diagnostics"])
+        entries, total_size, evicted = result_cache.evict()
+        logger.info(
+            f"Result cache miss: {cache_key} stored ({entries} entries, {total_size / 2**20:.1f} MB, {evicted} evicted)"
+        )
+    if not metrics_sink is None:
+        if not loaded is None:
+            cache = "artifact"
+        else:
+            cache = "off" if result_cache is None else "miss"
+        metrics_sink.record(results["metrics"], cache=cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+"""
+Module for the background writer of the exported files (data export, dependency index, diagnostics).
+
+The exported data is snapshotted into plain data by `finalize`, then encoded and written in the background while the main thread serializes the output AST. The JSON Lines export is the exception: its lines are rendered from the label registry, which is not changed after the numbering, and written one by one. Every file is written to a temporary file and renamed, so readers never see a partial file, even if the filter fails. The callers must `join` the writer before they exit, which also reports the write errors.
+
+In the command line filter, exports with many labels are written by a forked child process, which runs in parallel with the main thread instead of sharing the interpreter lock with it. The child gets the snapshot or the registry by the fork itself, nothing is pickled. Processes are only forked by writers created with `allow_processes` (only the command line filter, which owns its process: library callers such as `number_document` never fork the host), where fork is available and when no other thread is running, otherwise a thread is used.
+"""
+
+import multiprocessing
+import threading
+
+from .cache import write_atomic
+
+# Exports with at least this number of labels are written by a child process
+PROCESS_MIN_LABELS = 20000
+
+
+def can_fork():
+    return (
+        "fork" in multiprocessing.get_all_start_methods()
+        and threading.active_count() == 1
+    )
+
+
+def _write(path, encode, errors):
+    try:
+        write_atomic(path, encode())
+    except Exception as e:
+        errors.append(f"{type(e).__name__}: {e}")
+
+
+def _write_in_child(path, encode):
+    # Exceptions are printed by multiprocessing and give a non-zero exit code
+    write_atomic(path, encode())
+
+
+class ExportWriter:
+    def __init__(self, allow_processes=False):
+        # Whether `submit` may fork a child process, see the module docstring
+        self.allow_processes = allow_processes
+        # (path, thread or process, errors list of the thread or None for processes)
+        self.jobs = []
+
+    def __repr__(self):
+        return f"ExportWriter({[path for path, _, _ in self.jobs]})"
+
+    def submit(self, path, encode, use_process=False):
+        # `encode()` returns the content of the file as bytes or as an iterable of byte chunks (see `write_atomic`), it is called and iterated in the background and must only use plain data
+        if use_process and self.allow_processes and can_fork():
+            process = multiprocessing.get_context("fork").Process(
+                target=_write_in_child, args=(path, encode)
+            )
+            process.start()
+            self.jobs.append((path, process, None))
+        else:
+            errors = []
+            thread = threading.Thread(target=_write, args=(path, encode, errors))
+            thread.start()
+            self.jobs.append((path, thread, errors))
+
+    def join(self):
+        # Waits for all the writes, returns the list of (path, error message) of the failed ones
+        failures = []
+        for path, job, errors in self.jobs:
+            job.join()
+            if errors is None:
+                if job.exitcode != 0:
+                    failures.append(
+                        (path, f"writer process exited with code {job.exitcode}")
+                    )
+            elif errors:
+                failures.append((path, errors[0]))
+        self.jobs = []
+        return failures